@@ -0,0 +1,351 @@
+"""
+Benchmark of the forecast pipeline of the addon with synthetic InfluxDB data.
+
+    python benchmark/bench.py run [--days 365] [--requests 10] [--concurrency 4] [--out results.json]
+    python benchmark/bench.py compare base.json new.json
+
+`run` serves synthetic series through a local InfluxDB 1.8 stand-in (fake_influxdb.py)
+and measures:
+- stages: every stage of the pipeline in-process (InfluxDB I/O, parsing, delta energy,
+  training data reduction, fit, predict, serialization), repeated --repeat times.
+- endpoints: /forecast, /query and /energy_queries end-to-end against the addon started
+  in a subprocess (with its own DATA_DIR and PORT). Every scenario restarts the addon with
+  its options: 'cold' disables the caches so every request fits its model, 'cached' uses
+  the default options. It records the latency percentiles of --requests sequential
+  requests, the throughput of --concurrency parallel clients and the peak RSS of the
+  addon and its fit workers.
+The results are written as JSON with the git commit, so two runs can be compared with
+`compare`, which prints the ratio new/base of every metric.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import requests
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.join(BENCHMARK_DIR, '..', 'prophet-influx-multi-addon')
+sys.path.insert(0, ADDON_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+from fake_influxdb import FakeInfluxDB, serve  # noqa: E402
+from synthetic import SeriesShape, energy_counter, sensor  # noqa: E402
+
+ENERGY_QUERY = """SELECT last("value") AS "energy_kWh" FROM "kWh" WHERE "entity_id"='{}' GROUP BY time(1h) fill(previous)"""
+SENSOR_QUERY = """SELECT mean("value") AS "power_W" FROM "W" WHERE "entity_id"='{}' GROUP BY time(1h) fill(null)"""
+
+# Options of the addon in every scenario of the endpoint benchmarks
+SCENARIOS = {
+    'cold': {'MODEL_CACHE_SIZE': 0, 'RESULT_CACHE_SIZE': 0, 'MODEL_STORE': False, 'HISTORY_CACHE': False},
+    'cached': {},
+}
+
+
+def percentiles(samples: list) -> dict:
+    """ Summary of a list of durations in seconds """
+    values = np.asarray(samples, dtype=np.float64)
+    return {
+        'n': len(values),
+        'mean': float(values.mean()),
+        'min': float(values.min()),
+        'p50': float(np.percentile(values, 50)),
+        'p90': float(np.percentile(values, 90)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max()),
+    }
+
+
+def timed(function, repeat: int) -> tuple:
+    """ Run function repeat times, return (percentiles of the durations, last result) """
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start)
+    return percentiles(durations), result
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BENCHMARK_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def make_database(days: float) -> FakeInfluxDB:
+    """ Synthetic series: two energy counters and a power sensor sampled every minute """
+    db = FakeInfluxDB()
+    end = np.datetime64(int(time.time()) // 3600 * 3600, 's')
+    db.add_series('energy_grid', *energy_counter(SeriesShape(days=days, seed=1), end))
+    db.add_series('energy_solar', *energy_counter(SeriesShape(days=days, seed=2, daily_amplitude=1.0), end))
+    db.add_series('power_house', *sensor(SeriesShape(days=days, seed=3, step=60, level=500), end))
+    return db
+
+
+def write_options(data_dir: str, influx_port: int, overrides: dict):
+    options = {
+        'INFLUXDB_HOST': '127.0.0.1',
+        'INFLUXDB_PORT': influx_port,
+        'INFLUXDB_USER': 'bench',
+        'INFLUXDB_PASSWORD': '',
+        'INFLUXDB_DBNAME': 'homeassistant',
+        **overrides,
+    }
+    with open(os.path.join(data_dir, 'options.json'), 'w') as f:
+        json.dump(options, f)
+
+
+def bench_stages(args, influx_port: int) -> dict:
+    """ Duration of every stage of the pipeline, in-process """
+    from energy import delta_energy, sum_delta_energy
+    from fitting import fit_model, predict
+    from influx import SeriesBuffer, series_arrays
+    from reduction import reduce_training_data
+    from responses import FastJSONResponse, forecast_body
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('cmdstanpy').setLevel(logging.WARNING)
+
+    url = f"http://127.0.0.1:{influx_port}/query"
+    stages = {}
+
+    def influx_io(query):
+        params = {'q': query, 'db': 'homeassistant', 'epoch': 'ms', 'chunked': 'true', 'chunk_size': 10000}
+        return requests.get(url, params=params).content
+
+    def parse(body):
+        buffer = SeriesBuffer()
+        for line in body.splitlines():
+            if line:
+                buffer.append(*series_arrays(json.loads(line)['results'][0], epoch='ms'))
+        return buffer.arrays()
+
+    energy_queries = [ENERGY_QUERY.format('energy_grid'), ENERGY_QUERY.format('energy_solar')]
+    stages['influx_io'], body = timed(lambda: influx_io(energy_queries[0]), args.repeat)
+    stages['parse'], (times, values) = timed(lambda: parse(body), args.repeat)
+    series = [parse(influx_io(q)) for q in energy_queries]
+    stages['delta_energy'], (times, delta) = timed(
+        lambda: sum_delta_energy([delta_energy(*s) for s in series]), args.repeat)
+    df = pd.DataFrame({'ds': times, 'y': delta})
+    stages['reduction'], reduced = timed(lambda: reduce_training_data(df), args.repeat)
+    stages['fit'], model = timed(lambda: fit_model(reduced), max(1, args.repeat // 4))
+    stages['predict'], forecast = timed(lambda: predict(model, args.periods, 'h'), args.repeat)
+    stages['predict_fast'], _ = timed(lambda: predict(model, args.periods, 'h', fast=True), args.repeat)
+
+    def serialize():
+        return FastJSONResponse(forecast_body(forecast, utc=True)).body
+
+    stages['serialization'], _ = timed(serialize, args.repeat)
+    return {'rows': len(df), 'stages': stages}
+
+
+def process_tree_rss(pid: int) -> dict:
+    """ Peak and current RSS (bytes) of a process and its children, from /proc """
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    peak = current = 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as f:
+                status = dict(line.split(':', 1) for line in f if ':' in line)
+        except OSError:
+            continue
+        peak += int(status.get('VmHWM', '0 kB').split()[0]) * 1024
+        current += int(status.get('VmRSS', '0 kB').split()[0]) * 1024
+    return {'processes': len(pids), 'peak_rss': peak, 'rss': current}
+
+
+class Addon:
+    """ The addon running in a subprocess with its own DATA_DIR and PORT """
+
+    def __init__(self, data_dir: str, port: int, log_path: str):
+        self.url = f"http://127.0.0.1:{port}"
+        env = dict(os.environ, DATA_DIR=data_dir, PORT=str(port))
+        self.log = open(log_path, 'w')
+        self.process = subprocess.Popen([sys.executable, 'main.py'], cwd=ADDON_DIR, env=env,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + 120
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"The addon exited with code {self.process.returncode}, see {log_path}")
+            try:
+                requests.get(self.url + '/docs', timeout=1)
+                return
+            except requests.exceptions.ConnectionError:
+                time.sleep(0.2)
+        raise RuntimeError("The addon did not start")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+
+def endpoint_requests(args) -> dict:
+    """ Path and body of the request of every endpoint """
+    db_end = pd.Timestamp.now(tz='UTC').floor('h').tz_localize(None)
+    rng = np.random.default_rng(0)
+    ds = pd.date_range(end=db_end, periods=args.forecast_rows, freq='h')
+    y = 10 + 5 * np.sin(np.arange(args.forecast_rows) / 24 * 2 * np.pi) + rng.normal(0, 1, args.forecast_rows)
+    data = [{'ds': d, 'y': round(float(v), 3)} for d, v in zip(ds.strftime('%Y-%m-%dT%H:%M:%S'), y)]
+    return {
+        'forecast': ('/forecast', {'data': data, 'futurePeriods': args.periods}),
+        'query': ('/query', {'str_query': SENSOR_QUERY.format('power_house'), 'futurePeriods': args.periods}),
+        'energy_queries': ('/energy_queries', {'str_query1': ENERGY_QUERY.format('energy_grid'),
+                                               'str_query2': ENERGY_QUERY.format('energy_solar'),
+                                               'futurePeriods': args.periods}),
+    }
+
+
+def bench_endpoint(addon: Addon, path: str, body: dict, args) -> dict:
+    session = requests.Session()
+
+    def post():
+        response = session.post(addon.url + path, json=body, timeout=600)
+        response.raise_for_status()
+        return response
+
+    post()  # Warm-up: imports, first fit of the cached scenario
+    latency, _ = timed(post, args.requests)
+
+    def client(_):
+        with requests.Session() as s:
+            s.post(addon.url + path, json=body, timeout=600).raise_for_status()
+
+    total = args.concurrency * max(1, args.requests // 2)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(client, range(total)))
+    elapsed = time.perf_counter() - start
+    return {'latency': latency, 'throughput': {'concurrency': args.concurrency, 'requests': total,
+                                               'requests_per_second': total / elapsed}}
+
+
+def bench_endpoints(args, influx_port: int) -> dict:
+    results = {}
+    bodies = endpoint_requests(args)
+    for scenario in args.scenarios:
+        data_dir = tempfile.mkdtemp(prefix='prophet-bench-')
+        write_options(data_dir, influx_port, {**SCENARIOS[scenario], 'FIT_MAX_QUEUE': max(10, args.concurrency * 2)})
+        print(f"Scenario {scenario}: starting the addon on port {args.port}", flush=True)
+        addon = Addon(data_dir, args.port, os.path.join(data_dir, 'addon.log'))
+        try:
+            scenario_results = {}
+            for endpoint in args.endpoints:
+                path, body = bodies[endpoint]
+                scenario_results[endpoint] = bench_endpoint(addon, path, body, args)
+                latency = scenario_results[endpoint]['latency']
+                print(f"  {endpoint}: p50 {latency['p50']:.3f} s, p90 {latency['p90']:.3f} s, "
+                      f"{scenario_results[endpoint]['throughput']['requests_per_second']:.2f} req/s", flush=True)
+            scenario_results['memory'] = process_tree_rss(addon.process.pid)
+            results[scenario] = scenario_results
+        finally:
+            addon.stop()
+            if not args.keep:
+                shutil.rmtree(data_dir, ignore_errors=True)
+    return results
+
+
+def run(args):
+    db = make_database(args.days)
+    server = serve(db, args.influx_port)
+    influx_port = server.server_address[1]
+    results = {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'machine': {'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'config': {k: v for k, v in vars(args).items() if k not in ('command', 'out')},
+    }
+    try:
+        if not args.endpoints_only:
+            results['stages'] = bench_stages(args, influx_port)
+            for stage, summary in results['stages']['stages'].items():
+                print(f"Stage {stage}: p50 {summary['p50'] * 1000:.2f} ms", flush=True)
+        if not args.stages_only:
+            results['endpoints'] = bench_endpoints(args, influx_port)
+    finally:
+        server.shutdown()
+    results['influxdb'] = {'queries': db.queries, 'points_sent': db.points_sent}
+
+    out = args.out or os.path.join(BENCHMARK_DIR, 'results', f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {out}")
+
+
+def flatten(results: dict, prefix: str = '') -> dict:
+    """ Numeric metrics of a results file as {'endpoints.cold.query.latency.p50': value} """
+    metrics = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            metrics.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[name] = value
+    return metrics
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"base {base.get('commit')} ({base.get('date')}) -> new {new.get('commit')} ({new.get('date')})")
+    base_metrics, new_metrics = flatten(base), flatten(new)
+    wanted = ('.p50', '.p90', '.p99', '.mean', 'requests_per_second', 'peak_rss')
+    width = max((len(name) for name in new_metrics), default=10)
+    for name, value in new_metrics.items():
+        if not name.endswith(wanted) or name.startswith('config') or name not in base_metrics:
+            continue
+        ratio = value / base_metrics[name] if base_metrics[name] else float('nan')
+        print(f"{name:<{width}}  {base_metrics[name]:>14.4f}  {value:>14.4f}  {ratio:>7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--days', type=float, default=365, help='days of synthetic history')
+    run_parser.add_argument('--forecast-rows', type=int, default=24 * 90, help='rows of the /forecast payload')
+    run_parser.add_argument('--periods', type=int, default=48, help='futurePeriods of the requests')
+    run_parser.add_argument('--repeat', type=int, default=20, help='repetitions of every stage')
+    run_parser.add_argument('--requests', type=int, default=10, help='sequential requests per endpoint')
+    run_parser.add_argument('--concurrency', type=int, default=4, help='parallel clients of the throughput test')
+    run_parser.add_argument('--scenarios', type=lambda s: s.split(','), default=list(SCENARIOS))
+    run_parser.add_argument('--endpoints', type=lambda s: s.split(','), default=['forecast', 'query', 'energy_queries'])
+    run_parser.add_argument('--stages-only', action='store_true')
+    run_parser.add_argument('--endpoints-only', action='store_true')
+    run_parser.add_argument('--port', type=int, default=5055, help='port of the addon')
+    run_parser.add_argument('--influx-port', type=int, default=0, help='port of the InfluxDB stand-in, 0 = any')
+    run_parser.add_argument('--keep', action='store_true', help='keep the DATA_DIR of the addon (logs, models)')
+    run_parser.add_argument('--out', help='results file, benchmark/results/<commit>.json by default')
+    compare_parser = commands.add_parser('compare', help='compare two results files')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    args = parser.parse_args()
+    run(args) if args.command == 'run' else compare(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+Local stand-in of the HTTP API of InfluxDB 1.8 for the benchmarks.
+It serves synthetic series registered by entity_id, as Home Assistant writes them
+(measurement = unit, tag entity_id, field value), and understands the queries that
+the addon is used with:
+    SELECT last("value") AS "energy_kWh" FROM "kWh" WHERE "entity_id"='x'
+        [AND time >= '...' AND time <= now() - 1d] GROUP BY time(1h) [fill(...)]
+The aggregation (last, first, mean, max, min, sum or the raw points), the time bounds
+and fill(null|previous|none) are applied. The parameters epoch, chunked and chunk_size
+of /query behave like InfluxDB, so the addon reads the same bytes it would read from a
+real server. Like InfluxDB, the results are encoded in msgpack when the client accepts
+application/x-msgpack (influxdb-python does by default), JSON otherwise.
+
+It can also run alone:
+    python benchmark/fake_influxdb.py --port 8086 --days 365
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import msgpack
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'prophet-influx-multi-addon'))
+from influxql import group_by_interval, split_time_bounds  # noqa: E402
+
+ENTITY_RE = re.compile(r""""?entity_id"?\s*=\s*'([^']*)'""")
+AGGREGATION_RE = re.compile(r'SELECT\s+(last|first|mean|max|min|sum)\(', re.IGNORECASE)
+ALIAS_RE = re.compile(r'\)\s+AS\s+"?(\w+)"?', re.IGNORECASE)
+MEASUREMENT_RE = re.compile(r'FROM\s+"?([^"\s]+)"?', re.IGNORECASE)
+FILL_RE = re.compile(r'fill\((\w+)\)', re.IGNORECASE)
+
+# Aggregation of the points values[starts[i]:ends[i]] of every bucket
+AGGREGATIONS = {
+    'last': lambda values, starts, ends: values[ends - 1],
+    'first': lambda values, starts, ends: values[starts],
+    'mean': lambda values, starts, ends: np.add.reduceat(values, starts) / (ends - starts),
+    'max': lambda values, starts, ends: np.maximum.reduceat(values, starts),
+    'min': lambda values, starts, ends: np.minimum.reduceat(values, starts),
+    'sum': lambda values, starts, ends: np.add.reduceat(values, starts),
+}
+
+
+class FakeInfluxDB:
+    """ Series served by the stand-in, keyed by entity_id. Thread safe. """
+
+    def __init__(self, msgpack: bool = True):
+        self.msgpack = msgpack  # Answer in msgpack to the clients that accept it
+        self.series = {}  # entity_id -> (times datetime64[ns], values float64)
+        self.queries = 0
+        self.points_sent = 0
+        self._lock = threading.Lock()
+
+    def add_series(self, entity_id: str, times: np.ndarray, values: np.ndarray):
+        with self._lock:
+            self.series[entity_id] = (times.astype('datetime64[ns]'), values.astype(np.float64))
+
+    def execute(self, query: str) -> tuple:
+        """ Return (name, columns, times, values) of the result of query """
+        with self._lock:
+            self.queries += 1
+        entity = ENTITY_RE.search(query)
+        times, values = self.series.get(entity.group(1) if entity else None,
+                                        (np.empty(0, 'datetime64[ns]'), np.empty(0)))
+        measurement = MEASUREMENT_RE.search(query)
+        alias = ALIAS_RE.search(query)
+        name = measurement.group(1) if measurement else 'measurement'
+        columns = ['time', alias.group(1) if alias else 'value']
+
+        bounds = split_time_bounds(query)
+        start = end = None
+        if bounds is not None and bounds.start is not None:
+            start = np.datetime64(int(bounds.start * 1e9), 'ns')
+            times, values = (times[times >= start], values[times >= start]) if bounds.start_inclusive else \
+                (times[times > start], values[times > start])
+        if bounds is not None and bounds.end is not None:
+            end = np.datetime64(int(bounds.end * 1e9), 'ns')
+            times, values = (times[times <= end], values[times <= end]) if bounds.end_inclusive else \
+                (times[times < end], values[times < end])
+
+        interval = group_by_interval(query)
+        aggregation = AGGREGATION_RE.search(query)
+        if interval is None or aggregation is None or len(times) == 0:
+            return name, columns, times, values
+        step = int(interval[0] * 1e9)
+        offset = int(interval[1] * 1e9)
+        buckets = (times.astype(np.int64) - offset) // step
+        first_bucket = buckets[0] if start is None else (start.astype(np.int64) - offset) // step
+        last_bucket = (end.astype(np.int64) - offset) // step if end is not None else \
+            (time.time_ns() - offset) // step
+        all_buckets = np.arange(first_bucket, last_bucket + 1)
+        # Aggregate the points of every bucket with points
+        starts = np.searchsorted(buckets, all_buckets)
+        ends = np.append(starts[1:], len(buckets))
+        filled = ends > starts
+        result = np.full(len(all_buckets), np.nan)
+        if filled.any():
+            result[filled] = AGGREGATIONS[aggregation.group(1).lower()](values, starts[filled], ends[filled])
+        fill = FILL_RE.search(query)
+        fill = fill.group(1).lower() if fill else 'null'
+        if fill == 'previous':
+            valid = ~np.isnan(result)
+            last_valid = np.maximum.accumulate(np.where(valid, np.arange(len(result)), -1))
+            result = np.where(last_valid >= 0, result[np.maximum(last_valid, 0)], np.nan)
+        bucket_times = (all_buckets * step + offset).astype('datetime64[ns]')
+        if fill == 'none':
+            keep = ~np.isnan(result)
+            bucket_times, result = bucket_times[keep], result[keep]
+        return name, columns, bucket_times, result
+
+
+def _rows(times: np.ndarray, values: np.ndarray, epoch: str) -> list:
+    if epoch:
+        divisor = {'ns': 1, 'u': 10**3, 'ms': 10**6, 's': 10**9, 'm': 60 * 10**9, 'h': 3600 * 10**9}[epoch]
+        stamps = (times.astype(np.int64) // divisor).tolist()
+    else:
+        stamps = [t + 'Z' for t in np.datetime_as_string(times, unit='s').tolist()]
+    return [[t, None if v != v else v] for t, v in zip(stamps, values.tolist())]
+
+
+def make_handler(db: FakeInfluxDB):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _params(self) -> dict:
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            if self.command == 'POST':
+                length = int(self.headers.get('Content-Length', 0))
+                params.update(parse_qs(self.rfile.read(length).decode()))
+            return {k: v[0] for k, v in params.items()}
+
+        def _send(self, status: int, body: bytes = b'', content_type: str = 'application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Influxdb-Version', '1.8.10')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == '/ping':
+                return self._send(204)
+            if path == '/query':
+                return self._query()
+            self._send(404, b'{"error":"not found"}')
+
+        do_POST = do_GET
+
+        def _query(self):
+            params = self._params()
+            query = params.get('q', '')
+            try:
+                name, columns, times, values = db.execute(query)
+            except Exception as e:
+                return self._send(400, json.dumps({'error': str(e)}).encode())
+            rows = _rows(times, values, params.get('epoch'))
+            with db._lock:
+                db.points_sent += len(rows)
+            if db.msgpack and 'application/x-msgpack' in self.headers.get('Accept', ''):
+                # The chunks are consecutive msgpack objects, without separator
+                content_type = 'application/x-msgpack'
+                encode = msgpack.packb
+            else:
+                content_type = 'application/json'
+                encode = lambda result: json.dumps(result).encode() + b'\n'
+            if params.get('chunked') == 'true':
+                size = int(params.get('chunk_size', 10000))
+                chunks = [rows[i:i + size] for i in range(0, len(rows), size)] or [[]]
+                body = b''.join(
+                    encode({'results': [{'statement_id': 0, 'series': [{'name': name, 'columns': columns,
+                                                                        'values': chunk}] if chunk else [],
+                                         **({'partial': True} if i < len(chunks) - 1 else {})}]})
+                    for i, chunk in enumerate(chunks))
+            else:
+                series = [{'name': name, 'columns': columns, 'values': rows}] if rows else []
+                body = encode({'results': [{'statement_id': 0, **({'series': series} if series else {})}]})
+            self._send(200, body, content_type)
+
+    return Handler
+
+
+def serve(db: FakeInfluxDB, port: int) -> ThreadingHTTPServer:
+    """ Start the stand-in in a background thread, return the server (call shutdown() to stop it) """
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(db))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    from synthetic import SeriesShape, energy_counter, sensor
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--days', type=float, default=365)
+    parser.add_argument('--json', action='store_true', help='always answer in JSON, never in msgpack')
+    args = parser.parse_args()
+    db = FakeInfluxDB(msgpack=not args.json)
+    end = np.datetime64(int(time.time()) // 3600 * 3600, 's')
+    for i, entity in enumerate(['energy_grid', 'energy_solar', 'energy_battery']):
+        db.add_series(entity, *energy_counter(SeriesShape(days=args.days, seed=i), end))
+    db.add_series('power_house', *sensor(SeriesShape(days=args.days, seed=10, level=500), end))
+    print(f"Fake InfluxDB on port {args.port}, entities: {', '.join(db.series)}")
+    serve(db, args.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
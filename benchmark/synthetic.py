@@ -0,0 +1,64 @@
+"""
+Synthetic Home Assistant series for the benchmarks.
+- energy_counter: cumulative energy counter (kWh) like the sensors queried by /energy_queries,
+  with a daily profile, a weekly pattern, counter resets and gaps without data.
+- sensor: instantaneous sensor (W, °C...) like the series queried by /query.
+The series are numpy arrays (times datetime64[ns] in UTC, values float64) generated from a
+seed, so every run of the benchmark uses the same data.
+"""
+from dataclasses import dataclass
+import numpy as np
+
+
+@dataclass
+class SeriesShape:
+    """ Shape of a synthetic series """
+    days: float = 365  # Length of the history
+    step: int = 3600  # Seconds between points
+    level: float = 1.0  # Mean value per hour (energy) or mean value (sensor)
+    daily_amplitude: float = 0.8  # Relative amplitude of the daily profile
+    weekly_amplitude: float = 0.2  # Relative amplitude of the weekend effect
+    trend: float = 0.1  # Relative change of the level per year
+    noise: float = 0.2  # Relative standard deviation of the noise
+    resets: int = 2  # Counter resets (energy only)
+    gaps: int = 3  # Stretches without data
+    gap_hours: int = 12  # Length of every stretch without data
+    seed: int = 0
+
+
+def _profile(shape: SeriesShape, end: np.datetime64) -> tuple:
+    """ Times and the positive hourly rate of the series """
+    rng = np.random.default_rng(shape.seed)
+    n = int(shape.days * 86400 // shape.step)
+    times = end - np.arange(n, 0, -1) * np.timedelta64(shape.step, 's')
+    hours = (times - np.datetime64('1970-01-01T00:00:00')).astype('timedelta64[s]').astype(np.int64) / 3600
+    daily = 1 + shape.daily_amplitude * np.sin((hours % 24 - 6) / 24 * 2 * np.pi)
+    weekend = ((hours // 24 + 4) % 7) >= 5  # 1970-01-01 was a Thursday
+    weekly = 1 + shape.weekly_amplitude * np.where(weekend, 1, -0.4)
+    trend = 1 + shape.trend * (hours - hours[0]) / 8760
+    noise = rng.normal(1, shape.noise, n)
+    rate = np.clip(shape.level * daily * weekly * trend * noise, 0, None)
+    return times, rate, rng
+
+
+def _add_gaps(times: np.ndarray, values: np.ndarray, shape: SeriesShape, rng) -> tuple:
+    keep = np.ones(len(times), dtype=bool)
+    length = max(1, int(shape.gap_hours * 3600 // shape.step))
+    for start in rng.integers(0, max(1, len(times) - length), shape.gaps):
+        keep[start:start + length] = False
+    return times[keep], values[keep]
+
+
+def energy_counter(shape: SeriesShape, end: np.datetime64) -> tuple:
+    """ Cumulative energy counter ending at end, return (times, values) """
+    times, rate, rng = _profile(shape, end)
+    counter = np.cumsum(rate * shape.step / 3600)
+    for position in sorted(rng.integers(1, len(counter), shape.resets)):
+        counter[position:] -= counter[position]  # The counter starts again from 0
+    return _add_gaps(times, np.round(counter, 3), shape, rng)
+
+
+def sensor(shape: SeriesShape, end: np.datetime64) -> tuple:
+    """ Instantaneous sensor ending at end, return (times, values) """
+    times, rate, rng = _profile(shape, end)
+    return _add_gaps(times, np.round(rate, 3), shape, rng)
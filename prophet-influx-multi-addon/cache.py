@@ -0,0 +1,185 @@
+""" In-memory caches of the addon.
+LRUCache is a small least recently used cache with a time to live for its entries.
+FileCache has the same interface with its entries stored as files, shared by the
+uvicorn worker processes of the multi-worker mode.
+SingleFlight collapses concurrent identical requests into a single computation.
+The model cache keeps the fitted Prophet models together with a fingerprint of the
+data used to train them, so a new request can reuse the model when the data has not
+changed or warm-start the refit when the data has only grown.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import pickle
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+import pandas as pd
+from files import atomic_write, prune_lru
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """ Least recently used cache with max_entries and a ttl in seconds. """
+
+    def __init__(self, max_entries: int = 32, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expiration time, value)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Return the value stored for key or None if it is missing or expired. """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        # Evict the least recently used entries
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            logger.debug(f"Cache entry {evicted} evicted")
+
+    def clear(self):
+        self._entries.clear()
+
+
+class FileCache:
+    """ Cache with the interface of LRUCache stored in directory, one pickle file per key, so
+    all the processes of the addon share it. The modification time of the files is their
+    last use: the least recently used entries are removed beyond max_entries.
+    """
+
+    def __init__(self, directory: str, max_entries: int = 32, ttl: float = 3600):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key) -> str:
+        return os.path.join(self.directory, f"{key}.pkl")
+
+    def _keys(self) -> list:
+        try:
+            return [name[:-len('.pkl')] for name in os.listdir(self.directory) if name.endswith('.pkl')]
+        except FileNotFoundError:
+            return []
+
+    def __len__(self):
+        return len(self._keys())
+
+    def get(self, key):
+        """ Return the value stored for key or None if it is missing or expired. """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, value = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f"Invalid cache file {path}: {e}")
+            expires, value = 0, None
+        if expires < time.time():
+            self._remove(key)
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        entry = (time.time() + self.ttl, value)
+        atomic_write(self._path(key), lambda f: pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL))
+        # Evict the least recently used entries
+        for evicted in prune_lru(self.directory, '.pkl', max_entries=self.max_entries):
+            logger.debug(f"Cache entry {evicted} evicted")
+
+    def _remove(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for key in self._keys():
+            self._remove(key)
+
+
+class SingleFlight:
+    """ Run only one computation at a time per key. The concurrent callers with the
+    same key await the result (or the exception) of the computation in progress.
+    """
+
+    def __init__(self):
+        self._inflight = {}  # key -> asyncio.Task
+
+    def running(self, key) -> bool:
+        return key in self._inflight
+
+    async def run(self, key, compute):
+        """ Await compute() (a coroutine function) or the one already running for key """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(compute())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key, None))
+        # A cancelled caller (client disconnected) must not cancel the others
+        return await asyncio.shield(task)
+
+
+def cache_key(*parts) -> str:
+    """ Hash of the request fields that identify a model, e.g. the endpoint and the query """
+    return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class DataFingerprint:
+    """ Summary of the training data of a model """
+    rows: int
+    first: pd.Timestamp
+    last: pd.Timestamp
+    digest: str
+
+    def extends(self, other: "DataFingerprint") -> bool:
+        """ True if this data has new buckets after the end of other and overlaps it,
+        i.e. new points were appended (or a time window slid forward).
+        """
+        return self.last > other.last and self.first <= other.last
+
+
+def data_fingerprint(df: pd.DataFrame) -> DataFingerprint:
+    """ Fingerprint of a DataFrame with 'ds' and 'y' columns """
+    digest = hashlib.sha1(pd.util.hash_pandas_object(df[['ds', 'y']], index=False).values).hexdigest()
+    return DataFingerprint(rows=len(df), first=df['ds'].min(), last=df['ds'].max(), digest=digest)
+
+
+@dataclass
+class CachedModel:
+    model: object  # Fitted Prophet model
+    fingerprint: DataFingerprint
+    utc: bool = False  # Trained with UTC dates (InfluxDB), the predictions are returned with the offset
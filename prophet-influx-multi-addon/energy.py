@@ -0,0 +1,45 @@
+""" Energy per time bucket from the cumulative energy counters stored in InfluxDB.
+The queries must have GROUP BY time('time(1h)'). Normally h but can be changed to other time
+intervals. The series are numpy arrays: times (datetime64[ns] in UTC without timezone, as
+Prophet needs them) and values (float64).
+"""
+import logging
+from functools import reduce
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def delta_energy(times: np.ndarray, values: np.ndarray) -> tuple:
+    """ Return (times, delta_energy) with the energy of every bucket of a cumulative counter.
+    The first bucket is removed (its difference does not make sense) and so is the last one
+    (there isn´t enough data yet in the last hour). If there has been any counter reset the
+    difference is negative and it is set to NaN, Prophet can manage perfectly the NaN values.
+    """
+    if len(times) < 2:
+        raise ValueError("At least two points are needed to calculate the energy difference")
+    # Difference between consecutive values, computed directly for the buckets 1..n-2
+    delta = np.subtract(values[1:-1], values[:-2])
+    delta[delta < 0] = np.nan
+    return times[1:-1], delta
+
+
+def sum_delta_energy(series: list) -> tuple:
+    """ Sum the (times, delta_energy) of several queries.
+    The series are aligned on the union of their timestamps. A bucket missing in any of
+    the series is NaN, the NaN values are not filled (Prophet manages them).
+    """
+    times, total = series[0][0], series[0][1].copy()
+    if all(np.array_equal(other_times, times) for other_times, _ in series[1:]):
+        # Usual case: the same GROUP BY time range in all the queries
+        for _, delta in series[1:]:
+            total += delta
+        return times, total
+
+    times = reduce(np.union1d, [other_times for other_times, _ in series])
+    total = np.zeros(len(times))
+    for other_times, delta in series:
+        aligned = np.full(len(times), np.nan)
+        aligned[np.searchsorted(times, other_times)] = delta
+        total += aligned
+    return times, total
@@ -0,0 +1,63 @@
+""" Files of the stores under /data (models, results, history of the queries, scheduled jobs).
+They are shared by the uvicorn worker processes of the multi-worker mode and survive the
+restarts of the addon, so they are written atomically and pruned by their last use.
+"""
+import os
+
+
+def atomic_write(path: str, write, mode: str = 'wb'):
+    """ Write path with write(file), to a temporary file renamed over path, so a crash never
+    leaves a half written file. The temporary file is unique per process.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, mode) as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def prune_lru(directory: str, suffix: str, max_bytes: int = None, max_entries: int = None,
+              size=None, remove=None) -> list:
+    """ Remove the least recently used files of directory named <key><suffix> while they are
+    bigger than max_bytes or more than max_entries. Their last use is the modification time,
+    the stores update it with os.utime when they read a file.
+    size(key): bytes of key, the size of its file by default.
+    remove(key): removes key, its file by default.
+    Return the keys removed.
+    """
+    entries = []
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    for name in names:
+        if name.endswith(suffix):
+            key = name[:-len(suffix)]
+            try:
+                stat = os.stat(os.path.join(directory, name))
+                entries.append((stat.st_mtime, size(key) if size else stat.st_size, key))
+            except OSError:
+                continue
+    total = sum(nbytes for _, nbytes, _ in entries)
+    count = len(entries)
+    removed = []
+    for _, nbytes, key in sorted(entries):
+        if (max_bytes is None or total <= max_bytes) and (max_entries is None or count <= max_entries):
+            break
+        if remove is not None:
+            remove(key)
+        else:
+            try:
+                os.remove(os.path.join(directory, f"{key}{suffix}"))
+            except OSError:
+                pass
+        removed.append(key)
+        total -= nbytes
+        count -= 1
+    return removed
@@ -0,0 +1,171 @@
+""" Prophet jobs executed inside the worker processes of the fit pool.
+Every function here must be a top level function so it can be pickled and sent
+to a worker process. Arguments and results travel between processes, so keep them
+small: a DataFrame with the training data in and the forecast rows out.
+Prophet (and Stan) is imported by the first fit, not when the API process imports this
+module, so the uvicorn workers start without loading it.
+"""
+import logging
+import time
+from typing import TYPE_CHECKING
+import numpy as np
+import pandas as pd
+from metrics import span
+
+if TYPE_CHECKING:
+    from prophet import Prophet
+
+logger = logging.getLogger(__name__)
+
+# Settings of a model profile passed to the Prophet constructor
+PROPHET_ARGS = ('n_changepoints', 'changepoint_range', 'changepoint_prior_scale', 'yearly_seasonality',
+                'weekly_seasonality', 'daily_seasonality', 'seasonality_mode')
+# Settings of a model profile passed to the L-BFGS optimizer of Stan (Prophet.fit kwargs)
+OPTIMIZER_ARGS = ('iter', 'tol_obj', 'tol_rel_obj', 'tol_grad', 'tol_rel_grad', 'tol_param')
+
+# Predefined model profiles
+PROFILES = {
+    # Prophet defaults, the optimizer runs up to 10000 iterations until full convergence
+    'full': {},
+    # Fewer changepoints and a looser convergence, fits several times faster for interactive use
+    'quick': {'n_changepoints': 10, 'iter': 1000, 'tol_rel_obj': 1e6, 'tol_rel_grad': 1e9},
+}
+
+
+def warm_start_params(model: 'Prophet') -> dict:
+    """ Stan parameters of a fitted model to be used as init= of a new fit
+    (https://facebook.github.io/prophet/docs/additional_topics.html#updating-fitted-models)
+    """
+    res = {}
+    for pname in ['k', 'm', 'sigma_obs']:
+        res[pname] = model.params[pname][0][0]
+    for pname in ['delta', 'beta']:
+        res[pname] = model.params[pname][0]
+    return res
+
+
+def fit_model(df: pd.DataFrame, init: dict = None, profile: dict = None) -> 'Prophet':
+    """ Train a Prophet model with df (columns 'ds' and 'y').
+    init: parameters of a previous model to warm-start the optimizer.
+    profile: settings of the model and of the optimizer, see PROPHET_ARGS and OPTIMIZER_ARGS.
+    """
+    from prophet import Prophet
+
+    profile = profile or {}
+    prophet_args = {name: value for name, value in profile.items() if name in PROPHET_ARGS}
+    optimizer_args = {name: value for name, value in profile.items() if name in OPTIMIZER_ARGS}
+    if init is not None:
+        try:
+            return Prophet(**prophet_args).fit(df, init=init, **optimizer_args)
+        except Exception as e:
+            # The parameters may not match the new model (e.g. a new seasonality), fit it cold
+            logger.warning(f"Warm-start fit failed, fitting from scratch: {e}")
+    return Prophet(**prophet_args).fit(df, **optimizer_args)
+
+
+def forecast_columns(interval: bool = False) -> list:
+    """ Columns of the forecasts returned to the endpoints """
+    return ['ds', 'yhat', 'yhat_lower', 'yhat_upper'] if interval else ['ds', 'yhat']
+
+
+def predict_fast(model: 'Prophet', dates: pd.Series, interval: bool = False) -> pd.DataFrame:
+    """ Lean version of model.predict for the given dates.
+    model.predict computes every component column with its uncertainty interval and
+    samples the uncertainty of yhat, but the endpoints only use yhat. Here only the
+    trend and the additive and multiplicative terms are computed, the same way as
+    Prophet does, and the uncertainty is sampled only if interval is requested.
+    """
+    df = model.setup_dataframe(pd.DataFrame({'ds': dates}))
+    trend = model.predict_trend(df)
+    features, _, component_cols, _ = model.make_all_seasonality_features(df)
+    terms = {}
+    for component in ('additive_terms', 'multiplicative_terms'):
+        beta = model.params['beta'] * component_cols[component].values
+        terms[component] = np.nanmean(np.matmul(features.values, beta.transpose()), axis=1)
+    terms['additive_terms'] *= model.y_scale
+    forecast = pd.DataFrame({'ds': df['ds'].values,
+                             'yhat': trend * (1 + terms['multiplicative_terms']) + terms['additive_terms']})
+    if interval:
+        df['trend'] = trend
+        intervals = model.predict_uncertainty(df, vectorized=True)
+        forecast['yhat_lower'] = intervals['yhat_lower'].values
+        forecast['yhat_upper'] = intervals['yhat_upper'].values
+    return forecast
+
+
+def predict(model: 'Prophet', futurePeriods: int, futureFreq: str, fast: bool = False, interval: bool = False) -> pd.DataFrame:
+    """ Return the 'ds' and 'yhat' columns of the last futurePeriods forecasted rows.
+    fast: predict only the future rows with predict_fast, instead of the history and the future.
+    interval: also return the 'yhat_lower' and 'yhat_upper' columns.
+    """
+    with span("predict"):
+        if fast:
+            future = model.make_future_dataframe(periods=futurePeriods, freq=futureFreq, include_history=False)
+            return predict_fast(model, future['ds'], interval).tail(futurePeriods)
+        future = model.make_future_dataframe(periods=futurePeriods, freq=futureFreq)
+        forecast = model.predict(future)
+        return forecast[forecast_columns(interval)].tail(futurePeriods)
+
+
+def predict_dates(model: 'Prophet', dates: pd.Series, fast: bool = False, interval: bool = False) -> pd.DataFrame:
+    """ Return the 'ds' and 'yhat' columns of the forecast of the given dates """
+    with span("predict"):
+        if fast:
+            return predict_fast(model, dates, interval)
+        forecast = model.predict(pd.DataFrame({'ds': dates}))
+        return forecast[forecast_columns(interval)]
+
+
+def warm_up() -> float:
+    """ Import Prophet and load the Stan model with a tiny fit and prediction, so the first
+    request served by this worker process doesn't pay it. Return the seconds it took.
+    """
+    start = time.monotonic()
+    df = pd.DataFrame({'ds': pd.date_range('2024-01-01', periods=30, freq='D'), 'y': np.arange(30.0) % 7})
+    model = fit_model(df)
+    predict_fast(model, model.make_future_dataframe(periods=1, include_history=False)['ds'])
+    return time.monotonic() - start
+
+
+def backtest_cutoffs(ds: pd.Series, horizon: pd.Timedelta, initial: pd.Timedelta, period: pd.Timedelta) -> list:
+    """ Cutoffs of the cross-validation of the dates ds, the oldest first, see
+    prophet.diagnostics.generate_cutoffs. Raise ValueError if there is not enough data.
+    """
+    from prophet.diagnostics import generate_cutoffs
+
+    return generate_cutoffs(pd.DataFrame({'ds': ds}), horizon, initial, period)
+
+
+def backtest_cutoff(history: pd.DataFrame, test: pd.DataFrame, cutoff: pd.Timestamp, profile: dict = None) -> tuple:
+    """ Fit history (the data up to cutoff) and predict the dates of test, like
+    prophet.diagnostics.cross_validation does for one cutoff, without the uncertainty sampling.
+    Return the rows 'ds', 'yhat', 'y', 'cutoff' of the test dates and the seconds of the fit
+    and the prediction.
+    """
+    start = time.perf_counter()
+    with span("fit"):
+        model = fit_model(history, profile=profile)
+    with span("predict"):
+        forecast = predict_fast(model, test['ds'])
+    forecast['y'] = test['y'].values
+    forecast['cutoff'] = cutoff
+    return forecast, time.perf_counter() - start
+
+
+def backtest_metrics(cv: pd.DataFrame, rolling_window: float = 0) -> pd.DataFrame:
+    """ MAE, RMSE and MAPE per horizon of the cross-validation rows cv, see
+    prophet.diagnostics.performance_metrics. Prophet leaves MAPE out when y has values close to 0.
+    """
+    from prophet.diagnostics import performance_metrics
+
+    return performance_metrics(cv, metrics=['mae', 'rmse', 'mape'], rolling_window=rolling_window)
+
+
+def fit_predict(df: pd.DataFrame, futurePeriods: int, futureFreq: str, init: dict = None, fast: bool = False,
+                interval: bool = False, profile: dict = None) -> tuple:
+    """ Train a model with df and forecast futurePeriods.
+    Return the forecast and the fitted model, so the caller can cache it.
+    """
+    with span("fit"):
+        model = fit_model(df, init, profile)
+    return predict(model, futurePeriods, futureFreq, fast, interval), model
@@ -0,0 +1,154 @@
+""" Local store of the history of the InfluxDB queries, persisted under /data.
+Every request of /energy_queries used to read the complete history from InfluxDB again.
+The store keeps the points of every query (without its time bounds) in a numpy file, so
+only the points newer than the last stored bucket are requested to InfluxDB and appended.
+The last stored bucket is always requested again because it may not be complete yet.
+The files survive the restarts of the addon.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+import numpy as np
+from cache import cache_key
+from files import atomic_write, prune_lru
+from influxql import fill_option, split_time_bounds
+
+logger = logging.getLogger(__name__)
+
+POINT_DTYPE = np.dtype([('time', 'datetime64[ns]'), ('value', np.float64)])
+
+
+def fill_previous(values: np.ndarray, previous: np.ndarray) -> np.ndarray:
+    """ Fill the leading NaN of the new values of a fill(previous) query with the last stored value.
+    The incremental query has no point before its range to carry forward, so its buckets before
+    the first new point are null where the query of the whole range has the previous value.
+    """
+    if not len(values) or not len(previous) or not np.isnan(values[0]):
+        return values
+    known = np.flatnonzero(~np.isnan(values))
+    leading = known[0] if len(known) else len(values)
+    values = values.copy()
+    values[:leading] = previous[-1]
+    return values
+
+
+class HistoryStore:
+    """ Points of the queries stored in directory, one .npy file (and its .json metadata) per query.
+    max_points: points kept per query, the oldest ones are pruned and not used anymore.
+    max_bytes: size of the whole store, the least recently used queries are removed.
+    refresh: seconds after which the history of a query is read again completely from
+    InfluxDB (to pick up points written late).
+    """
+
+    def __init__(self, directory: str, max_points: int = 200000, max_bytes: int = 100 * 2**20, refresh: float = 86400):
+        self.directory = directory
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self._locks = defaultdict(threading.Lock)  # One lock per query
+
+    def query(self, connection: tuple, str_query: str, run_query) -> tuple:
+        """ Return the (times, values) of str_query using the stored history.
+        connection: (host, port, dbname, ...) of the InfluxDB server and its credentials, part of the key.
+        run_query(str_query): function that executes a query and returns its (times, values).
+        """
+        bounds = split_time_bounds(str_query)
+        if bounds is None:
+            logger.debug("Query time bounds not supported by the history store")
+            return run_query(str_query)
+        key = cache_key(*connection, bounds.base_query)
+        start = None if bounds.start is None else np.datetime64(int(bounds.start * 1e9), 'ns')
+        end = None if bounds.end is None else np.datetime64(int(bounds.end * 1e9), 'ns')
+
+        with self._locks[key]:
+            stored = self._load(key)
+            if stored is None or not self._covers(stored, start):
+                # Read the whole range of the query
+                times, values = run_query(str_query)
+                times, values = self._save(key, bounds.base_query, times, values,
+                                           None if start is None else float(bounds.start), time.time())
+                logger.info(f"History of query {key[:12]} read from InfluxDB ({len(times)} points)")
+                return times, values
+
+            points, metadata = stored
+            last = points['time'][-1] if len(points) else None
+            if last is not None and end is not None and end < last:
+                new_times, new_values = points['time'][:0], points['value'][:0]
+            else:
+                query_from = bounds.query_from(np.datetime_as_string(last, unit='s') + 'Z') if last is not None else str_query
+                new_times, new_values = run_query(query_from)
+            # The last stored bucket is replaced by its new value
+            keep = points['time'] < new_times[0] if len(new_times) else slice(None)
+            if fill_option(str_query) == 'previous':
+                new_values = fill_previous(new_values, points['value'][keep])
+            times = np.concatenate([points['time'][keep], new_times])
+            values = np.concatenate([points['value'][keep], new_values])
+            times, values = self._save(key, bounds.base_query, times, values, metadata['start'], metadata['created'],
+                                       metadata.get('pruned', False))
+            logger.info(f"History of query {key[:12]}: {len(new_times)} new points from InfluxDB, {len(times)} stored")
+
+        # Apply the time bounds of the query to the stored points
+        mask = np.ones(len(times), dtype=bool)
+        if start is not None:
+            mask &= times >= start if bounds.start_inclusive else times > start
+        if end is not None:
+            mask &= times <= end if bounds.end_inclusive else times < end
+        return times[mask], values[mask]
+
+    def _covers(self, stored: tuple, start) -> bool:
+        """ True if the stored history can answer a query from start """
+        points, metadata = stored
+        if time.time() - metadata['created'] > self.refresh:
+            return False
+        if metadata['start'] is None or metadata.get('pruned'):
+            return True  # The whole history is stored, or the older points were dropped on purpose
+        return start is not None and np.datetime64(int(metadata['start'] * 1e9), 'ns') <= start
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{key}.{extension}")
+
+    def _load(self, key: str):
+        """ Return (points, metadata) of key or None if it is not stored """
+        try:
+            with open(self._path(key, 'json')) as f:
+                metadata = json.load(f)
+            points = np.load(self._path(key, 'npy'), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        os.utime(self._path(key, 'json'))  # Last use, for the pruning of the store
+        return points, metadata
+
+    def _save(self, key: str, base_query: str, times: np.ndarray, values: np.ndarray, start, created: float,
+              pruned: bool = False) -> tuple:
+        """ Store the points of key and return the (times, values) kept """
+        if len(times) > self.max_points:
+            # Prune the oldest points, the history now starts at the first kept point
+            times, values = times[-self.max_points:], values[-self.max_points:]
+            start = times[0].astype('datetime64[ns]').astype(np.int64) / 1e9
+            pruned = True
+        points = np.empty(len(times), dtype=POINT_DTYPE)
+        points['time'] = times
+        points['value'] = values
+        os.makedirs(self.directory, exist_ok=True)
+        # The points are written first, the metadata file is the one listed by the pruning
+        metadata = {'query': base_query, 'start': start, 'created': created, 'pruned': pruned}
+        atomic_write(self._path(key, 'npy'), lambda f: np.save(f, points))
+        atomic_write(self._path(key, 'json'), lambda f: json.dump(metadata, f), mode='w')
+        self._prune()
+        return times, values
+
+    def _prune(self):
+        """ Remove the least recently used queries while the store is bigger than max_bytes """
+        for key in prune_lru(self.directory, '.json', max_bytes=self.max_bytes,
+                             size=lambda key: os.path.getsize(self._path(key, 'npy')), remove=self._remove):
+            logger.info(f"Removed history of query {key[:12]} from the store")
+
+    def _remove(self, key: str):
+        for extension in ('npy', 'json'):
+            try:
+                os.remove(self._path(key, extension))
+            except OSError:
+                pass
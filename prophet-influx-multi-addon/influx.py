@@ -0,0 +1,231 @@
+""" InfluxDB access: parsing of the query results and registry of reusable clients.
+Every InfluxDBClient owns a requests session with its own pool of HTTP connections.
+Creating one per request pays a new TCP handshake every time and leaks the sockets,
+so the clients are created lazily, one per (host, port, user, dbname), and reused.
+The influxdb package is imported with the first client, /forecast doesn't need it.
+"""
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING
+import numpy as np
+import pandas as pd
+from metrics import span
+
+if TYPE_CHECKING:
+    from influxdb import InfluxDBClient
+
+logger = logging.getLogger(__name__)
+
+
+# Units of the epoch parameter of the queries as numpy datetime64 units
+EPOCH_UNITS = {'ns': 'ns', 'u': 'us', 'ms': 'ms', 's': 's', 'm': 'm', 'h': 'h'}
+
+
+def to_datetime64(times, epoch: str = None) -> np.ndarray:
+    """ Convert the time column of an InfluxDB result to datetime64[ns] in UTC without timezone.
+    The times are epoch integers if the query used epoch=, otherwise RFC3339 strings.
+    """
+    if len(times) and not isinstance(times[0], str):
+        return np.asarray(times, dtype=np.int64).astype(f"datetime64[{EPOCH_UNITS[epoch or 'ns']}]").astype('datetime64[ns]')
+    return pd.to_datetime(times, utc=True, format='ISO8601').tz_localize(None).values.astype('datetime64[ns]')
+
+
+def series_arrays(raw: dict, epoch: str = None, single_value: bool = False) -> tuple:
+    """ Parse the JSON of an InfluxDB query result (ResultSet.raw) into numpy arrays.
+    Return (times, values) with the time column and the first value column as float64,
+    None values become NaN. The series of all the tags are concatenated, like get_points().
+    single_value: raise ValueError if the result has other columns than time and one value.
+    """
+    times, values = [], []
+    for series in raw.get('series', []):
+        columns = series['columns']
+        if 'time' not in columns:
+            raise ValueError("Column 'time' not found in the input data")
+        if single_value and (len(columns) != 2 or series.get('tags')):
+            raise ValueError("Expected two columns 'time' and the query value")
+        time_index = columns.index('time')
+        value_index = next(i for i in range(len(columns)) if i != time_index)
+        if not series.get('values'):
+            continue
+        # Transpose the rows into columns in C, without building a dict per point
+        series_columns = list(zip(*series['values']))
+        times.append(to_datetime64(series_columns[time_index], epoch))
+        values.append(np.asarray(series_columns[value_index], dtype=np.float64))
+    if not times:
+        return np.empty(0, dtype='datetime64[ns]'), np.empty(0, dtype=np.float64)
+    if len(times) == 1:
+        return times[0], values[0]
+    return np.concatenate(times), np.concatenate(values)
+
+
+def group_mean(times: np.ndarray, values: np.ndarray, factor: int) -> tuple:
+    """ Aggregate every group of factor consecutive points into one point with the time
+    of the first point and the mean of the values, ignoring NaN (all NaN gives NaN).
+    len(times) must be a multiple of factor.
+    """
+    groups = values.reshape(-1, factor)
+    valid = ~np.isnan(groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(valid, groups, 0).sum(axis=1) / valid.sum(axis=1)
+    return times[::factor], means
+
+
+class SeriesBuffer:
+    """ Growing numpy buffers where the chunks of a query result are appended.
+    max_points: if > 0, the points are averaged on the fly in groups of consecutive
+    points. The group size is doubled every time the buffer would hold more than
+    max_points, so the memory stays bounded whatever the length of the query.
+    """
+
+    def __init__(self, max_points: int = 0, capacity: int = 4096):
+        self.max_points = max_points
+        self.factor = 1  # Raw points per stored point
+        self.size = 0
+        self._times = np.empty(capacity, dtype='datetime64[ns]')
+        self._values = np.empty(capacity, dtype=np.float64)
+        # Raw points waiting to complete a group of factor points
+        self._pending_times = self._times[:0]
+        self._pending_values = self._values[:0]
+
+    def append(self, times: np.ndarray, values: np.ndarray):
+        if self.factor > 1:
+            times = np.concatenate([self._pending_times, times])
+            values = np.concatenate([self._pending_values, values])
+            complete = len(times) // self.factor * self.factor
+            self._pending_times, self._pending_values = times[complete:], values[complete:]
+            times, values = group_mean(times[:complete], values[:complete], self.factor)
+        self._extend(times, values)
+        while self.max_points > 0 and self.size > self.max_points:
+            self._halve()
+
+    def arrays(self) -> tuple:
+        """ Return (times, values) with all the points appended """
+        if len(self._pending_times):
+            # The last incomplete group becomes one point
+            times, values = group_mean(self._pending_times, self._pending_values, len(self._pending_times))
+            self._pending_times, self._pending_values = self._times[:0], self._values[:0]
+            self._extend(times, values)
+        return self._times[:self.size], self._values[:self.size]
+
+    def _extend(self, times: np.ndarray, values: np.ndarray):
+        end = self.size + len(times)
+        if end > len(self._times):
+            capacity = max(end, 2 * len(self._times))
+            self._times = np.resize(self._times, capacity)
+            self._values = np.resize(self._values, capacity)
+        self._times[self.size:end] = times
+        self._values[self.size:end] = values
+        self.size = end
+
+    def _halve(self):
+        """ Average the stored points in pairs and double the group size """
+        complete = self.size // 2 * 2
+        times, values = group_mean(self._times[:complete], self._values[:complete], 2)
+        half = len(times)
+        if complete < self.size:
+            # An odd last point goes back to the raw points waiting for the next group, repeated
+            # as the factor raw points it averages, so every stored point has the same weight
+            self._pending_times = np.concatenate([np.repeat(self._times[complete:self.size], self.factor),
+                                                  self._pending_times])
+            self._pending_values = np.concatenate([np.repeat(self._values[complete:self.size], self.factor),
+                                                   self._pending_values])
+        self._times[:len(times)] = times
+        self._values[:len(values)] = values
+        self.size = len(times)
+        self.factor *= 2
+        logger.debug(f"Query result downsampled to {half} points of {self.factor} raw points")
+
+
+def query_arrays(client: 'InfluxDBClient', str_query: str, chunk_size: int = 10000, max_points: int = 0,
+                 single_value: bool = False) -> tuple:
+    """ Execute a query with a chunked response and return its (times, values) arrays.
+    Each chunk is parsed and appended to a SeriesBuffer as it arrives, so the full
+    JSON response and a dict per point are never held in memory at the same time.
+    max_points: see SeriesBuffer.
+    """
+    buffer = SeriesBuffer(max_points=max_points)
+    for result in client.query(str_query, epoch='ms', chunked=True, chunk_size=chunk_size):
+        with span("parse"):
+            buffer.append(*series_arrays(result.raw, epoch='ms', single_value=single_value))
+    return buffer.arrays()
+
+
+class InfluxClientPool:
+    """ Lazily created InfluxDB clients shared by all the requests.
+    pool_size: HTTP connections kept by each client.
+    keepalive: seconds an unused client is kept before closing it.
+    health_check: seconds without use after which a client is pinged before reusing it.
+    timeout: seconds to connect and to wait for data of every request of the clients, None = no limit.
+    get() may block (ping), call it in a thread from the event loop.
+    """
+
+    def __init__(self, pool_size: int = 10, keepalive: float = 300, health_check: float = 60, timeout: float = 30):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.health_check = health_check
+        self._clients = {}  # key -> [client, password, last use]
+        self._lock = threading.Lock()
+
+    def get(self, host: str, port: int, user: str, password: str, dbname: str) -> 'InfluxDBClient':
+        """ Return the client of (host, port, user, dbname), creating it if needed """
+        key = (host, port, user, dbname)
+        self.close_idle()
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is not None and entry[1] != password:
+                # The credentials changed, don't reuse the old session
+                self._close(key)
+                entry = None
+        if entry is not None and time.monotonic() - entry[2] > self.health_check and not self._alive(entry[0]):
+            logger.warning(f"InfluxDB client {host}:{port}/{dbname} is not responding, reconnecting")
+            self.evict(host, port, user, dbname)
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is None:
+                from influxdb import InfluxDBClient
+                # JSON only: with msgpack (the default Accept of the client) the chunked responses
+                # are read whole and the chunk reader of query_arrays fails
+                client = InfluxDBClient(host=host, port=port, username=user, password=password,
+                                        database=dbname, pool_size=self.pool_size, timeout=self.timeout,
+                                        headers={'Accept': 'application/json'})
+                entry = [client, password, 0]
+                self._clients[key] = entry
+                logger.debug(f"Created InfluxDB client for {host}:{port}/{dbname}")
+            entry[2] = time.monotonic()
+            return entry[0]
+
+    def evict(self, host: str, port: int, user: str, dbname: str):
+        """ Close the client of (host, port, user, dbname), e.g. after a connection error """
+        with self._lock:
+            self._close((host, port, user, dbname))
+
+    def close_idle(self):
+        """ Close the clients not used in the last keepalive seconds """
+        now = time.monotonic()
+        with self._lock:
+            for key in [k for k, entry in self._clients.items() if now - entry[2] > self.keepalive]:
+                logger.debug(f"Closing idle InfluxDB client for {key[0]}:{key[1]}/{key[3]}")
+                self._close(key)
+
+    def close(self):
+        with self._lock:
+            for key in list(self._clients):
+                self._close(key)
+
+    def _close(self, key):
+        entry = self._clients.pop(key, None)
+        if entry is not None:
+            try:
+                entry[0].close()
+            except Exception as e:
+                logger.debug(f"Error closing InfluxDB client: {e}")
+
+    @staticmethod
+    def _alive(client: 'InfluxDBClient') -> bool:
+        try:
+            client.ping()
+            return True
+        except Exception:
+            return False
@@ -0,0 +1,274 @@
+""" Helpers to build, inspect and rewrite InfluxQL query strings. """
+import re
+import time
+from datetime import datetime
+
+# InfluxQL duration units in seconds
+DURATION_UNITS = {
+    'ns': 1e-9,
+    'u': 1e-6,
+    'µ': 1e-6,
+    'ms': 1e-3,
+    's': 1,
+    'm': 60,
+    'h': 3600,
+    'd': 86400,
+    'w': 604800,
+}
+
+DURATION_RE = r'(?:\d+(?:ns|u|µ|ms|s|m|h|d|w))+'
+GROUP_BY_TIME_RE = re.compile(r'GROUP\s+BY\s+(?:.*?\b)?time\(\s*(' + DURATION_RE + r')\s*(?:,\s*(-?' + DURATION_RE + r')\s*)?\)',
+                              re.IGNORECASE)
+
+
+def parse_duration(duration: str) -> float:
+    """ Convert an InfluxQL duration literal like '1h' or '1h30m' to seconds """
+    sign = -1 if duration.startswith('-') else 1
+    parts = re.findall(r'(\d+)(ns|u|µ|ms|s|m|h|d|w)', duration)
+    if not parts:
+        raise ValueError(f"Invalid duration: {duration}")
+    return sign * sum(int(value) * DURATION_UNITS[unit] for value, unit in parts)
+
+
+def group_by_interval(str_query: str):
+    """ Return (interval, offset) in seconds of the GROUP BY time(interval[, offset])
+    clause of the query, or None if the query doesn't group by time.
+    """
+    match = GROUP_BY_TIME_RE.search(str_query)
+    if match is None:
+        return None
+    interval = parse_duration(match.group(1))
+    offset = parse_duration(match.group(2)) if match.group(2) else 0
+    return interval, offset
+
+
+FILL_CLAUSE_RE = re.compile(r'\bfill\(\s*([^)\s]+)\s*\)', re.IGNORECASE)
+
+
+def fill_option(str_query: str):
+    """ Option of the fill() clause of the query in lower case (e.g. 'previous'), None without fill() """
+    match = FILL_CLAUSE_RE.search(str_query)
+    return match.group(1).lower() if match else None
+
+
+def time_bucket(interval: float, offset: float = 0, now: float = None) -> int:
+    """ Index of the GROUP BY time bucket that contains now (epoch seconds).
+    InfluxDB aligns the buckets to the unix epoch plus the offset.
+    """
+    if now is None:
+        now = time.time()
+    return int((now - offset) // interval)
+
+
+# Clauses that can follow the WHERE clause of a SELECT
+WHERE_END_RE = re.compile(r'\s+(?:GROUP\s+BY|ORDER\s+BY|LIMIT|SLIMIT|OFFSET|SOFFSET|tz\()|\s*;', re.IGNORECASE)
+AND_RE = re.compile(r'\s+AND\s+', re.IGNORECASE)
+OR_RE = re.compile(r'\s+OR\s+', re.IGNORECASE)
+TIME_CONDITION_RE = re.compile(r"^time\s*(>=|<=|>|<)\s*(?:'([^']*)'|now\(\)(?:\s*([-+])\s*(" + DURATION_RE + r"))?)$",
+                               re.IGNORECASE)
+
+
+def _top_level_matches(text: str, pattern: re.Pattern) -> list:
+    """ Matches of pattern in text that are not inside quotes or parentheses """
+    matches = []
+    depth = 0
+    quote = None
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if char == '\\':
+                i += 2  # Escaped character of a quoted string, e.g. 'O\'Brien'
+                continue
+            if char == quote:
+                quote = None
+        elif char in ('"', "'"):
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth == 0:
+            match = pattern.match(text, i)
+            if match:
+                matches.append(match)
+                i = max(match.end(), i + 1)
+                continue
+        i += 1
+    return matches
+
+
+def _unwrap(condition: str) -> str:
+    """ Remove the parentheses around a whole condition, e.g. (time >= '2024-10-01T00:00:00Z') """
+    condition = condition.strip()
+    while condition.startswith('(') and condition.endswith(')'):
+        inner = condition[1:-1]
+        depth = 0
+        for char in re.sub(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"", '', inner):
+            depth += {'(': 1, ')': -1}.get(char, 0)
+            if depth < 0:
+                return condition  # The first parenthesis closes before the end, e.g. (a) AND (b)
+        condition = inner.strip()
+    return condition
+
+
+def _time_literal(match: re.Match, now: float) -> float:
+    """ Epoch seconds of the value of a time condition """
+    if match.group(2) is not None:
+        return datetime.fromisoformat(match.group(2).replace('Z', '+00:00')).timestamp()
+    seconds = now
+    if match.group(4):
+        sign = -1 if match.group(3) == '-' else 1
+        seconds += sign * parse_duration(match.group(4))
+    return seconds
+
+
+class TimeBounds:
+    """ A query split into its time bounds and the rest of its WHERE clause.
+    start, end: epoch seconds or None. start_inclusive/end_inclusive tell if the bound is >= / <=.
+    """
+
+    def __init__(self, prefix: str, conditions: list, suffix: str, start, start_inclusive, end, end_inclusive, end_conditions):
+        self.prefix = prefix
+        self.conditions = conditions
+        self.suffix = suffix
+        self.start = start
+        self.start_inclusive = start_inclusive
+        self.end = end
+        self.end_inclusive = end_inclusive
+        self.end_conditions = end_conditions
+
+    @property
+    def base_query(self) -> str:
+        """ The query without its time bounds, it identifies the data whatever the time range """
+        return self._build(self.conditions)
+
+    def query_from(self, start: str) -> str:
+        """ The query restricted to time >= start (RFC3339) and the original end bound """
+        return self._build([f"time >= '{start}'"] + self.end_conditions + self.conditions)
+
+    def _build(self, conditions: list) -> str:
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+        return f"{self.prefix}{where}{self.suffix}"
+
+
+def split_time_bounds(str_query: str, now: float = None):
+    """ Split the time conditions out of the WHERE clause of a SELECT query.
+    Only conditions joined by AND and compared with RFC3339 strings or now() are understood.
+    Return a TimeBounds or None if the query is not supported (e.g. OR with time conditions).
+    """
+    if now is None:
+        now = time.time()
+    str_query = str_query.strip()
+    where = re.search(r'\s+WHERE\s+', str_query, re.IGNORECASE)
+    if where is None:
+        end_match = _top_level_matches(str_query, WHERE_END_RE)
+        split = end_match[0].start() if end_match else len(str_query)
+        return TimeBounds(str_query[:split], [], str_query[split:], None, True, None, True, [])
+    prefix = str_query[:where.start()]
+    rest = str_query[where.end():]
+    end_match = _top_level_matches(rest, WHERE_END_RE)
+    split = end_match[0].start() if end_match else len(rest)
+    clause, suffix = rest[:split], rest[split:]
+
+    if _top_level_matches(clause, OR_RE):
+        return None  # Removing conditions from an OR would change its meaning
+
+    conditions = []
+    end_conditions = []
+    start = end = None
+    start_inclusive = end_inclusive = True
+    position = 0
+    parts = []
+    for match in _top_level_matches(clause, AND_RE):
+        parts.append(clause[position:match.start()])
+        position = match.end()
+    parts.append(clause[position:])
+    for part in parts:
+        condition = _unwrap(part)
+        match = TIME_CONDITION_RE.match(condition)
+        if match is None:
+            if re.search(r'\btime\b', condition, re.IGNORECASE):
+                return None  # A time condition that is not understood
+            conditions.append(part.strip())
+            continue
+        operator = match.group(1)
+        try:
+            value = _time_literal(match, now)
+        except ValueError:
+            return None
+        if operator.startswith('>'):
+            if start is not None:
+                return None
+            start, start_inclusive = value, operator == '>='
+        else:
+            if end is not None:
+                return None
+            end, end_inclusive = value, operator == '<='
+            end_conditions.append(part.strip())
+    return TimeBounds(prefix, conditions, suffix, start, start_inclusive, end, end_inclusive, end_conditions)
+
+
+# Aggregations of build_query, they are pushed down to InfluxDB with GROUP BY time()
+AGGREGATIONS = ('mean', 'median', 'sum', 'count', 'min', 'max', 'first', 'last', 'spread')
+FILL_RE = re.compile(r'^(?:none|null|previous|linear|-?\d+(?:\.\d+)?)$')
+
+
+def quote_identifier(name: str) -> str:
+    """ Double-quoted InfluxQL identifier (measurement, tag or field key) """
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def quote_string(value: str) -> str:
+    """ Single-quoted InfluxQL string literal (tag value, date) """
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def _time_condition(operator: str, value: str) -> str:
+    """ Time condition of a bound given as a duration back from now ('30d') or as an RFC3339 date """
+    if re.fullmatch(DURATION_RE, value):
+        return f"time {operator} now() - {value}"
+    try:
+        datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f"Invalid time bound {value}, expected a duration like 30d or an RFC3339 date")
+    return f"time {operator} {quote_string(value)}"
+
+
+def build_query(measurement: str, field: str = 'value', tags: dict = None, aggregation: str = 'mean',
+                bucket: str = '1h', start: str = None, end: str = None, fill: str = 'none') -> str:
+    """ InfluxQL query of a series aggregated by InfluxDB in time buckets:
+    SELECT <aggregation>("<field>") FROM "<measurement>" WHERE <tags> AND <time bounds>
+    GROUP BY time(<bucket>) fill(<fill>)
+    tags: tag values the points must have, e.g. {'entity_id': 'energy_total'}.
+    start, end: durations back from now ('30d') or RFC3339 dates, None for no bound.
+    Raise ValueError if an argument is not valid.
+    """
+    if aggregation not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation {aggregation}, expected one of {', '.join(AGGREGATIONS)}")
+    if not re.fullmatch(DURATION_RE, bucket) or parse_duration(bucket) <= 0:
+        raise ValueError(f"Invalid bucket {bucket}, expected a duration like 1h")
+    if not FILL_RE.match(fill):
+        raise ValueError(f"Invalid fill {fill}, expected none, null, previous, linear or a number")
+    conditions = [f"{quote_identifier(key)} = {quote_string(value)}" for key, value in (tags or {}).items()]
+    if start is not None:
+        conditions.append(_time_condition('>=', start))
+    if end is not None:
+        conditions.append(_time_condition('<', end))
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+    return (f"SELECT {aggregation}({quote_identifier(field)}) AS {quote_identifier(field)} "
+            f"FROM {quote_identifier(measurement)}{where} GROUP BY time({bucket}) fill({fill})")
+
+
+def estimated_rows(str_query: str, now: float = None):
+    """ Rows returned by a query grouped by time: the buckets between its time bounds (now if it
+    has no end). None if it can't be estimated, without GROUP BY time() or without start bound.
+    """
+    if now is None:
+        now = time.time()
+    interval = group_by_interval(str_query)
+    bounds = split_time_bounds(str_query, now)
+    if interval is None or bounds is None or bounds.start is None:
+        return None
+    end = bounds.end if bounds.end is not None else now
+    return max(0, int((end - bounds.start) // interval[0]) + 1)
@@ -0,0 +1,91 @@
+""" Parsing of the training data of /forecast into the DataFrame of the fit.
+The data can be sent in three forms:
+- JSON rows: "data": [{"ds": "2024-01-01T00:00:00", "y": 1.5}, ...], the original format.
+- JSON columns: "data": {"ds": [...], "y": [...]}, with ISO dates or epoch numbers in unit.
+  The arrays are validated by pydantic-core while it parses the JSON and converted to
+  numpy in one call, there is no dict per row.
+- Binary: Arrow IPC stream (Content-Type application/vnd.apache.arrow.stream, needs
+  pyarrow) or packed buffers (application/octet-stream): n little-endian int64 epoch
+  timestamps in unit followed by n little-endian float64 values. The buffers are read
+  zero-copy with numpy.
+The dates become datetime64[ns] without timezone. Epoch numbers are in UTC, ISO dates
+with an offset keep their local time, like the JSON rows.
+"""
+import numpy as np
+import pandas as pd
+from fastapi import HTTPException
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # Optional, the Arrow upload answers 415 without it
+    pyarrow = None
+
+ARROW_CONTENT_TYPES = ('application/vnd.apache.arrow.stream', 'application/vnd.apache.arrow.file')
+PACKED_CONTENT_TYPE = 'application/octet-stream'
+# Units of the epoch timestamps, the same names as the epoch parameter of InfluxDB
+EPOCH_UNITS = {'ns': 'ns', 'u': 'us', 'ms': 'ms', 's': 's'}
+
+
+def epoch_datetimes(times: np.ndarray, unit: str = 's') -> np.ndarray:
+    """ Convert epoch numbers in unit to datetime64[ns] """
+    if unit not in EPOCH_UNITS:
+        raise HTTPException(status_code=400, detail=f"Unknown epoch unit {unit}, expected one of {', '.join(EPOCH_UNITS)}")
+    if times.dtype.kind == 'f':
+        # Fractional epochs are rounded to nanoseconds
+        scale = {'ns': 1, 'u': 10**3, 'ms': 10**6, 's': 10**9}[unit]
+        return np.round(times * scale).astype(np.int64).astype('datetime64[ns]')
+    return times.astype(np.int64).astype(f"datetime64[{EPOCH_UNITS[unit]}]").astype('datetime64[ns]')
+
+
+def frame(times: np.ndarray, values: np.ndarray) -> pd.DataFrame:
+    if len(times) != len(values):
+        raise HTTPException(status_code=400, detail=f"ds has {len(times)} values and y has {len(values)}")
+    if len(times) == 0:
+        raise HTTPException(status_code=400, detail="No data provided")
+    return pd.DataFrame({'ds': times, 'y': values})
+
+
+def columns_frame(ds: list, y: list, unit: str = 's') -> pd.DataFrame:
+    """ DataFrame of the JSON columns ds (ISO strings or epoch numbers) and y (None is NaN) """
+    values = np.asarray(y, dtype=np.float64)
+    if ds and isinstance(ds[0], str):
+        times = pd.to_datetime(pd.Series(ds)).dt.tz_localize(None).values
+    else:
+        times = epoch_datetimes(np.asarray(ds), unit)
+    return frame(times, values)
+
+
+def packed_frame(body: bytes, unit: str = 's') -> pd.DataFrame:
+    """ DataFrame of packed buffers: n int64 epoch timestamps then n float64 values """
+    if len(body) % 16:
+        raise HTTPException(status_code=400, detail="The packed data must be n int64 timestamps and n float64 values")
+    n = len(body) // 16
+    times = np.frombuffer(body, dtype='<i8', count=n)
+    values = np.frombuffer(body, dtype='<f8', count=n, offset=n * 8)
+    return frame(epoch_datetimes(times, unit), values)
+
+
+def arrow_frame(body: bytes, unit: str = 's') -> pd.DataFrame:
+    """ DataFrame of an Arrow IPC stream (or file) with the columns ds and y, or the first two
+    columns. ds is a timestamp column (converted to UTC) or epoch numbers in unit.
+    """
+    if pyarrow is None:
+        raise HTTPException(status_code=415, detail="Arrow uploads need pyarrow, it is not installed")
+    try:
+        reader = pyarrow.ipc.open_stream(body) if not body.startswith(b'ARROW1') else pyarrow.ipc.open_file(body)
+        table = reader.read_all()
+    except pyarrow.ArrowInvalid as e:
+        raise HTTPException(status_code=400, detail=f"Invalid Arrow data: {e}")
+    if table.num_columns < 2:
+        raise HTTPException(status_code=400, detail="Expected two columns 'ds' and 'y'")
+    names = table.column_names
+    ds = table.column('ds' if 'ds' in names else 0).combine_chunks()
+    y = table.column('y' if 'y' in names else 1).combine_chunks()
+    if pyarrow.types.is_timestamp(ds.type):
+        # The values of a timestamp column are UTC, also with a timezone
+        times = ds.cast(pyarrow.timestamp('ns')).to_numpy(zero_copy_only=False)
+    else:
+        times = epoch_datetimes(ds.to_numpy(zero_copy_only=False), unit)
+    values = y.cast(pyarrow.float64()).to_numpy(zero_copy_only=False)
+    return frame(times, values)
@@ -1,37 +1,276 @@
+import asyncio
+import fcntl
+import hashlib
 import logging
 import json
 import os
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from prophet import Prophet
-import numpy as np
-import pandas as pd
-from influxdb import InfluxDBClient
+import sys
+import time
+from contextlib import asynccontextmanager
+from functools import reduce
+from typing import Literal
 
 # Set logger
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Directory of the persistent data of the addon, DATA_DIR can move it (e.g. to run the benchmarks)
+DATA_DIR = os.getenv("DATA_DIR", "/data")
+
 # Cargar opciones de /data/options.json
-with open('/data/options.json') as f:
+with open(os.path.join(DATA_DIR, 'options.json')) as f:
     options = json.load(f)
 
+FIT_THREADS = options.get("FIT_THREADS", 1) # Threads per fit (BLAS, OpenMP, Stan), 0 = no limit
+# The numeric libraries size their thread pools when numpy is imported, and the fit workers
+# are forked with those pools, so the limit must be in the environment before the imports
+if int(FIT_THREADS) > 0:
+    for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'STAN_NUM_THREADS'):
+        os.environ.setdefault(variable, str(FIT_THREADS))
+
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field, StrictFloat, StrictInt, StrictStr, ValidationError, field_validator, model_validator
+import numpy as np
+import pandas as pd
+import requests
+from cache import FileCache, LRUCache, CachedModel, SingleFlight, cache_key, data_fingerprint
+from energy import delta_energy, sum_delta_energy
+from influx import InfluxClientPool, query_arrays
+from influxql import AGGREGATIONS, build_query, estimated_rows, group_by_interval, parse_duration, time_bucket
+from history import HistoryStore
+from reduction import reduce_training_data
+from model_store import ModelStore
+from scheduler import ForecastJob, Scheduler
+from fitting import (PROFILES, backtest_cutoff, backtest_cutoffs, backtest_metrics, fit_predict, predict, predict_dates,
+                     warm_start_params, warm_up)
+from workers import PRIORITIES, FitPool, fit_priority
+from responses import FastJSONResponse, forecast_body, iso_strings
+from ingest import ARROW_CONTENT_TYPES, PACKED_CONTENT_TYPE, arrow_frame, columns_frame, packed_frame
+import metrics
+from metrics import Timings, current_timings, span
+
 # Configuraciones cargadas de options.json
 INFLUXDB_HOST = options.get("INFLUXDB_HOST", "InfluxAddon host_name or external IP, examples: a0d7b954-influxdb or 192.168.0.100")
 INFLUXDB_PORT = options.get("INFLUXDB_PORT", 8086)
 INFLUXDB_USER = options.get("INFLUXDB_USER", "user")
 INFLUXDB_PASSWORD = options.get("INFLUXDB_PASSWORD", "password")
 INFLUXDB_DBNAME = options.get("INFLUXDB_DBNAME", "database")
+FIT_WORKERS = options.get("FIT_WORKERS", 0) # 0 = one worker process per CPU core
+FIT_TIMEOUT = options.get("FIT_TIMEOUT", 300) # Seconds
+FIT_MAX_QUEUE = options.get("FIT_MAX_QUEUE", 10)
+MODEL_CACHE_SIZE = options.get("MODEL_CACHE_SIZE", 32) # Fitted models kept in memory, 0 disables the cache
+MODEL_CACHE_TTL = options.get("MODEL_CACHE_TTL", 86400) # Seconds
+MODEL_STORE = options.get("MODEL_STORE", True) # Persist the fitted models under /data
+MODEL_STORE_MAX_MB = options.get("MODEL_STORE_MAX_MB", 200) # Size of the stored models
+RESULT_CACHE_SIZE = options.get("RESULT_CACHE_SIZE", 64) # Forecast responses kept in memory, 0 disables the cache
+RESULT_CACHE_TTL = options.get("RESULT_CACHE_TTL", 3600) # Seconds
+INFLUXDB_POOL_SIZE = options.get("INFLUXDB_POOL_SIZE", 10) # HTTP connections per InfluxDB client
+INFLUXDB_KEEPALIVE = options.get("INFLUXDB_KEEPALIVE", 300) # Seconds an unused InfluxDB client is kept open
+INFLUXDB_TIMEOUT = options.get("INFLUXDB_TIMEOUT", 30) # Seconds to connect to InfluxDB and to wait for its data
+INFLUXDB_CHUNK_SIZE = options.get("INFLUXDB_CHUNK_SIZE", 10000) # Points per chunk of the InfluxDB responses
+INFLUXDB_MAX_POINTS = options.get("INFLUXDB_MAX_POINTS", 0) # Downsample /query results to this number of points, 0 = no limit
+QUERY_MAX_ROWS = options.get("QUERY_MAX_ROWS", 500000) # Estimated rows allowed per query grouped by time, 0 = no limit
+HISTORY_CACHE = options.get("HISTORY_CACHE", True) # Keep the history of the /energy_queries queries under /data
+HISTORY_MAX_POINTS = options.get("HISTORY_MAX_POINTS", 200000) # Points kept per query, the oldest ones are pruned
+HISTORY_MAX_MB = options.get("HISTORY_MAX_MB", 100) # Size of the whole history store
+HISTORY_REFRESH = options.get("HISTORY_REFRESH", 86400) # Seconds after which a history is read again completely
+FORECAST_JOBS = options.get("FORECAST_JOBS", []) # Forecasts computed in the background, see forecast_jobs()
+FORECAST_JOBS_STAGGER = options.get("FORECAST_JOBS_STAGGER", 30) # Seconds between the runs of consecutive jobs
+MODEL_PROFILE = options.get("MODEL_PROFILE", "full") # Model profile of the requests without profile
+MODEL_PROFILES = options.get("MODEL_PROFILES", []) # Named model profiles added to the predefined ones
+TRAIN_MAX_ROWS = options.get("TRAIN_MAX_ROWS", 0) # Rows budget of a fit, older rows are downsampled. 0 = no limit
+TRAIN_MAX_DAYS = options.get("TRAIN_MAX_DAYS", 0) # Days of training data, 0 = all
+TRAIN_FULL_RESOLUTION_DAYS = options.get("TRAIN_FULL_RESOLUTION_DAYS", 0) # Older rows are downsampled, 0 = none
+TRAIN_COARSE_INTERVAL = options.get("TRAIN_COARSE_INTERVAL", "1d") # Buckets of the downsampled rows
+GZIP_MIN_SIZE = options.get("GZIP_MIN_SIZE", 16384) # Responses from this size (bytes) are gzipped if the client accepts it, 0 = never
+WORKERS = int(options.get("WORKERS", 1)) # uvicorn worker processes (see run.sh), they share the caches under /data
+WARMUP = options.get("WARMUP", True) # Load Prophet in the fit processes at startup, /ready tells when it is done
+
+# With several uvicorn workers, the fit processes and the in-memory models are split between them
+# and the caches are shared through /data: the model store and a file-backed result cache
+shared = WORKERS > 1
+
+# Prophet fits run in worker processes so they don't block the event loop
+fit_workers = int(FIT_WORKERS) or os.cpu_count() or 1
+if shared:
+    fit_workers = max(1, fit_workers // WORKERS)
+fit_pool = FitPool(max_workers=fit_workers, timeout=FIT_TIMEOUT, max_queue=int(FIT_MAX_QUEUE),
+                   threads=int(FIT_THREADS))
+
+# Fitted models of the previous requests, keyed by a hash of the query or of the data
+model_cache = LRUCache(max_entries=-(-int(MODEL_CACHE_SIZE) // WORKERS), ttl=MODEL_CACHE_TTL)
+# The same models on disk, loaded lazily after a restart or stored by another worker
+model_store = ModelStore(os.path.join(DATA_DIR, "models"),
+                         max_bytes=int(MODEL_STORE_MAX_MB) * 2**20) if MODEL_STORE or shared else None
+
+# Forecast responses of the InfluxDB endpoints, valid until the GROUP BY time bucket rolls over
+if shared:
+    result_cache = FileCache(os.path.join(DATA_DIR, "cache", "results"), max_entries=int(RESULT_CACHE_SIZE),
+                             ttl=RESULT_CACHE_TTL)
+else:
+    result_cache = LRUCache(max_entries=int(RESULT_CACHE_SIZE), ttl=RESULT_CACHE_TTL)
+# Identical requests in progress share the same computation
+single_flight = SingleFlight()
+# Forecasts of the cutoffs of /backtest, keyed by the data, the cutoff and the model configuration
+backtest_cache = LRUCache(max_entries=512, ttl=MODEL_CACHE_TTL)
+
+# InfluxDB clients reused by all the requests
+influx_pool = InfluxClientPool(pool_size=int(INFLUXDB_POOL_SIZE), keepalive=INFLUXDB_KEEPALIVE,
+                               timeout=INFLUXDB_TIMEOUT)
+
+# History of the energy queries, only the new points are requested to InfluxDB
+history_store = HistoryStore(os.path.join(DATA_DIR, "history"), max_points=int(HISTORY_MAX_POINTS),
+                             max_bytes=int(HISTORY_MAX_MB) * 2**20, refresh=HISTORY_REFRESH) if HISTORY_CACHE else None
+
+# Background forecast jobs, created at startup
+scheduler = None
+scheduler_lock = None
+
+# Warm-up of the fit pool, see warm_up_fit_pool()
+warmup_task = None
+warmup_status = {"ready": not WARMUP, "seconds": None, "error": None}
+
+async def warm_up_fit_pool():
+    """ Run a tiny fit in every process of the fit pool, in the background at startup.
+    The processes import Prophet and load the Stan model before the first request needs
+    them. The jobs are submitted together, so every one starts its own process.
+    """
+    start = time.monotonic()
+    try:
+        seconds = await asyncio.gather(*[fit_pool.run(warm_up) for _ in range(fit_pool.max_workers)])
+        logger.info(f"Fit pool warmed up in {time.monotonic() - start:.2f} s "
+                    f"(slowest process {max(seconds):.2f} s)")
+    except Exception as e:
+        # The addon works without the warm-up, the first fit loads Prophet instead
+        warmup_status["error"] = str(getattr(e, 'detail', e))
+        logger.error(f"Fit pool warm-up failed: {warmup_status['error']}")
+    warmup_status["seconds"] = round(time.monotonic() - start, 3)
+    warmup_status["ready"] = True
+
+def acquire_scheduler_lock() -> bool:
+    """ True if this process runs the forecast jobs: the only process, or the uvicorn worker
+    that holds the lock file (until it exits, then another worker restarting can take it).
+    """
+    global scheduler_lock
+    if not shared:
+        return True
+    lock = open(os.path.join(DATA_DIR, "scheduler.lock"), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return False
+    scheduler_lock = lock
+    return True
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global scheduler, warmup_task
+    if WARMUP:
+        warmup_task = asyncio.create_task(warm_up_fit_pool())
+    scheduler = Scheduler(forecast_jobs(FORECAST_JOBS), run_forecast_job,
+                          directory=os.path.join(DATA_DIR, "jobs") if shared else None)
+    if acquire_scheduler_lock():
+        scheduler.start()
+    yield
+    if warmup_task is not None:
+        warmup_task.cancel()
+    await scheduler.stop()
+    fit_pool.shutdown()
+    influx_pool.close()
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+if GZIP_MIN_SIZE:
+    app.add_middleware(GZipMiddleware, minimum_size=int(GZIP_MIN_SIZE), compresslevel=6)
+
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    """ Time the stages of every request, see metrics.py. The durations are returned in
+    the Server-Timing header (visible in the network tab of the browsers) in milliseconds.
+    """
+    timings = Timings()
+    current_timings.set(timings)
+    # Priority class of the fits of the request, interactive unless the client asks for bulk
+    priority = request.headers.get("X-Priority", "interactive").lower()
+    if priority not in PRIORITIES:
+        return FastJSONResponse({"detail": f"X-Priority must be one of {', '.join(PRIORITIES)}"}, status_code=400)
+    fit_priority.set(priority)
+    response = await call_next(request)
+    response.headers["Server-Timing"] = timings.header()
+    route = request.scope.get("route")
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - timings.start, path=route.path if route else "other",
+                                    status=response.status_code)
+    return response
+
+class ModelProfile(BaseModel):
+    """ Settings of the Prophet model and of its optimizer, None keeps the value of the preset """
+    preset: str = None # Profile the settings are applied on, MODEL_PROFILE if not set
+    n_changepoints: int = None
+    changepoint_range: float = None
+    changepoint_prior_scale: float = None
+    yearly_seasonality: bool | int | str = None # True/False, 'auto' or the Fourier order
+    weekly_seasonality: bool | int | str = None
+    daily_seasonality: bool | int | str = None
+    seasonality_mode: str = None # additive or multiplicative
+    iter: int = None # Maximum iterations of the optimizer
+    tol_obj: float = None
+    tol_rel_obj: float = None
+    tol_grad: float = None
+    tol_rel_grad: float = None
+    tol_param: float = None
+
+    @field_validator('yearly_seasonality', 'weekly_seasonality', 'daily_seasonality', mode='before')
+    @classmethod
+    def parse_seasonality(cls, value):
+        # options.json only has strings: "true", "false", "auto" or the Fourier order
+        if isinstance(value, str) and value.lower() in ('true', 'false'):
+            return value.lower() == 'true'
+        if isinstance(value, str) and value.isdigit():
+            return int(value)
+        return value
+
+class SeriesColumns(BaseModel):
+    """ Training data of /forecast as parallel arrays, validated strictly (no "1.5" strings) """
+    ds: list[StrictInt] | list[StrictFloat] | list[StrictStr] # ISO dates or epoch numbers
+    y: list[StrictFloat | None]
+    unit: Literal["ns", "u", "ms", "s"] = "s" # Unit of the epoch numbers
 
 class ForecastRequest(BaseModel):
-    data: list
+    data: list | SeriesColumns = None # Rows [{"ds": ..., "y": ...}, ...] or columns {"ds": [...], "y": [...]}
     futurePeriods: int = 30
     futureFreq: str = "h"
+    fast: bool = False # Lean prediction of the future rows only, without uncertainty sampling
+    interval: bool = False # Return yhat_lower and yhat_upper too
+    profile: str | ModelProfile = None # Name of a model profile or its settings, MODEL_PROFILE if not set
+    max_rows: int = int(TRAIN_MAX_ROWS) # Rows budget of the fit, the older rows are downsampled. 0 = no limit
+    format: Literal["dict", "columns", "epoch"] = "dict" # Shape of the response, see responses.py
+
+class StructuredQuery(BaseModel):
+    """ A series of InfluxDB described by its fields instead of InfluxQL, see build_query.
+    The aggregation, fill() and time bounds are applied by InfluxDB, only the buckets are downloaded.
+    """
+    measurement: str # e.g. kWh or °C with the InfluxDB integration of Home Assistant
+    field: str = "value"
+    entity_id: str = None # Tag entity_id, the entity without its domain (energy_total for sensor.energy_total)
+    tags: dict[str, str] = {} # Other tags the points must have, e.g. {"domain": "sensor"}
+    aggregation: Literal[AGGREGATIONS] = None # mean for /query, last for /energy_queries
+    bucket: str = "1h" # GROUP BY time(bucket)
+    start: str = "365d" # Duration back from now or RFC3339 date, None = all the data
+    end: str = None # Duration back from now or RFC3339 date, None = until now
+    fill: str = None # none, null, previous, linear or a number. none for /query, previous for /energy_queries
+
+    def str_query(self, aggregation: str, fill: str) -> str:
+        """ InfluxQL of the query, aggregation and fill are the defaults of the endpoint """
+        tags = {"entity_id": self.entity_id, **self.tags} if self.entity_id is not None else self.tags
+        return build_query(self.measurement, self.field, tags, self.aggregation or aggregation, self.bucket,
+                           self.start, self.end, self.fill or fill)
 
 class QueryRequest(BaseModel):
-    str_query: str
+    str_query: str = None
+    query: StructuredQuery = None # Instead of str_query, the InfluxQL is built by the addon
     influx_host: str = INFLUXDB_HOST # os.getenv("INFLUXDB_HOST", "localhost")
     influx_port: int = int(INFLUXDB_PORT) # int(os.getenv("INFLUXDB_PORT", 8086))
     influx_user: str = INFLUXDB_USER # os.getenv("INFLUXDB_USER", "homeassistant")
@@ -39,10 +278,30 @@ class QueryRequest(BaseModel):
     influx_dbname: str = INFLUXDB_DBNAME # os.getenv("INFLUXDB_DBNAME", "homeassistant")
     futurePeriods: int = 30
     futureFreq: str = "h"
+    max_points: int = int(INFLUXDB_MAX_POINTS) # Average consecutive points to train with at most max_points, 0 = all
+    fast: bool = False
+    interval: bool = False
+    profile: str | ModelProfile = None
+    max_rows: int = int(TRAIN_MAX_ROWS)
+    format: Literal["dict", "columns", "epoch"] = "dict"
+
+    @model_validator(mode='after')
+    def build_str_query(self):
+        # The structured query becomes str_query, the rest of the pipeline (cache keys...) only sees InfluxQL
+        if self.query is not None:
+            if self.str_query is not None:
+                raise ValueError("Give str_query or query, not both")
+            self.str_query = self.query.str_query("mean", "none")
+            self.query = None
+        if self.str_query is None:
+            raise ValueError("str_query or query is required")
+        return self
 
 class EnergyQueryRequest(BaseModel):
-    str_query1: str
+    str_query1: str = None
     str_query2: str = None
+    str_queries: list[str] = [] # More energy queries summed to str_query1 and str_query2
+    counters: list[StructuredQuery] = [] # Energy counters given by their fields, added to str_queries
     influx_host: str = INFLUXDB_HOST # os.getenv("INFLUXDB_HOST", "localhost")
     influx_port: int = int(INFLUXDB_PORT) # int(os.getenv("INFLUXDB_PORT", 8086))
     influx_user: str = INFLUXDB_USER # os.getenv("INFLUXDB_USER", "homeassistant")
@@ -50,12 +309,255 @@ class EnergyQueryRequest(BaseModel):
     influx_dbname: str = INFLUXDB_DBNAME # os.getenv("INFLUXDB_DBNAME", "homeassistant")
     futurePeriods: int = 30
     futureFreq: str = "h"
+    fast: bool = False
+    interval: bool = False
+    profile: str | ModelProfile = None
+    max_rows: int = int(TRAIN_MAX_ROWS)
+    format: Literal["dict", "columns", "epoch"] = "dict"
+    components: bool = False # Also forecast every query on its own, see energy_components_forecast
+    total: Literal["fit", "sum"] = "fit" # With components: fit the total or sum the component forecasts
 
-@app.post("/forecast")
-async def forecast(request: ForecastRequest):
+    @model_validator(mode='after')
+    def build_str_queries(self):
+        # Cumulative counters: the last value of every bucket, the empty buckets keep the previous one
+        str_queries = [counter.str_query("last", "previous") for counter in self.counters]
+        self.counters = []
+        if self.str_query1 is None and str_queries:
+            self.str_query1 = str_queries.pop(0)
+        self.str_queries = self.str_queries + str_queries
+        if self.str_query1 is None:
+            raise ValueError("str_query1 or counters is required")
+        return self
+
+class PredictRequest(BaseModel):
+    model_id: str = Field(pattern=r'^[0-9a-f]{40}$') # X-Model-Id header of a previous forecast
+    futurePeriods: int = 30
+    futureFreq: str = "h"
+    timestamps: list[str] = None # Dates to predict instead of futurePeriods
+    fast: bool = False
+    interval: bool = False
+    format: Literal["dict", "columns", "epoch"] = "dict"
+
+class BacktestConfig(BaseModel):
+    """ Model configuration evaluated by /backtest """
+    name: str = None # Name in the response, the name of the profile by default
+    profile: str | ModelProfile = None
+    max_rows: int = int(TRAIN_MAX_ROWS)
+    max_days: float = TRAIN_MAX_DAYS # Days of training data before every cutoff, 0 = all
+
+class BacktestRequest(BaseModel):
+    data: list | SeriesColumns = None # Data like /forecast, or an InfluxDB query in str_query or query
+    str_query: str = None
+    query: StructuredQuery = None
+    influx_host: str = INFLUXDB_HOST
+    influx_port: int = int(INFLUXDB_PORT)
+    influx_user: str = INFLUXDB_USER
+    influx_password: str = INFLUXDB_PASSWORD
+    influx_dbname: str = INFLUXDB_DBNAME
+    max_points: int = int(INFLUXDB_MAX_POINTS)
+    horizon: str = "1 days" # Forecast horizon of every cutoff, as a pandas Timedelta
+    initial: str = None # Training data before the first cutoff, 3 horizons by default
+    period: str = None # Spacing of the cutoffs, half horizon by default
+    max_cutoffs: int = 10 # Only the latest cutoffs are evaluated
+    rolling_window: float = 0 # Fraction of the rows averaged per horizon, 0 = one row per horizon
+    configs: list[BacktestConfig] = [BacktestConfig()]
+
+    @model_validator(mode='after')
+    def build_str_query(self):
+        if self.query is not None:
+            if self.str_query is not None:
+                raise ValueError("Give str_query or query, not both")
+            self.str_query = self.query.str_query("mean", "none")
+            self.query = None
+        if (self.data is None) == (self.str_query is None):
+            raise ValueError("Give data, str_query or query")
+        return self
+
+class ForecastBatchRequest(BaseModel):
+    series: list[ForecastRequest]
+
+class QueryBatchRequest(BaseModel):
+    queries: list[QueryRequest]
+
+class EnergyQueryBatchRequest(BaseModel):
+    queries: list[EnergyQueryRequest]
+
+def resolve_profile(profile: str | ModelProfile = None) -> dict:
+    """ Settings of a model profile given by name or as a ModelProfile applied on its preset.
+    The profiles of MODEL_PROFILES in options.json are looked up before the predefined ones.
+    """
+    if profile is None:
+        profile = MODEL_PROFILE
+    if isinstance(profile, str):
+        if profile in custom_profiles:
+            return custom_profiles[profile]
+        if profile in PROFILES:
+            return PROFILES[profile]
+        logger.error(f"Unknown model profile {profile}")
+        raise HTTPException(status_code=400, detail=f"Unknown model profile {profile}")
+    settings = dict(resolve_profile(profile.preset))
+    settings.update(profile.model_dump(exclude={'preset'}, exclude_none=True))
+    return dict(sorted(settings.items()))
+
+# Named profiles of options.json, their settings are applied on their preset (full by default)
+custom_profiles = {}
+for config in MODEL_PROFILES:
+    try:
+        custom_profiles[config["name"]] = resolve_profile(ModelProfile(**{"preset": "full", **config}))
+    except Exception as e:
+        logger.error(f"Invalid model profile {config.get('name')}: {getattr(e, 'detail', e)}")
+
+async def cached_forecast(key: str, df: pd.DataFrame, futurePeriods: int, futureFreq: str, http_response: Response,
+                          fast: bool = False, interval: bool = False, profile: dict = None,
+                          max_rows: int = 0, utc: bool = False) -> pd.DataFrame:
+    """ Forecast df in the fit pool reusing the cached model of key when possible.
+    The X-Model-Cache response header tells what happened with the model:
+    hit: same training data, the cached model only predicts.
+    warm: the data has new points, the refit is warm-started from the cached model.
+    miss: the model is fitted from scratch.
+    The X-Model-Id response header is key, it can be used with /predict.
+    fast, interval: see fitting.predict.
+    profile: settings of the model, see resolve_profile. They must be part of key.
+    max_rows: rows budget of the fit, see reduction.reduce_training_data.
+    The X-Training-Rows response header has the rows used to train the model.
+    utc: the dates of df are UTC (InfluxDB data), /predict returns them with the '+00:00' offset.
+    """
+    # Reduce the training data (and drop the NaN rows) before the fingerprint and the fit
+    rows = len(df)
+    df = reduce_data(df, max_rows)
+    if len(df) < rows:
+        logger.debug(f"Training data reduced from {rows} to {len(df)} rows")
+    fingerprint = data_fingerprint(df)
+    cached = await cached_model(key, fingerprint)
+    if cached is not None and cached.fingerprint == fingerprint:
+        status = "hit"
+        forecast = await fit_pool.run(predict, cached.model, futurePeriods, futureFreq, fast, interval)
+    else:
+        init = None
+        status = "miss"
+        if cached is not None and fingerprint.extends(cached.fingerprint):
+            status = "warm"
+            init = warm_start_params(cached.model)
+        forecast, model = await fit_pool.run(fit_predict, df, futurePeriods, futureFreq, init, fast, interval, profile)
+        metrics.TRAINING_ROWS.observe(len(df))
+        cached = CachedModel(model=model, fingerprint=fingerprint, utc=utc)
+        model_cache.set(key, cached)
+        if model_store is not None:
+            try:
+                with span("store"):
+                    await asyncio.to_thread(model_store.set, key, cached)
+            except Exception as e:
+                logger.error(f"Error storing model {key[:12]}: {e}")
+    logger.info(f"Model cache {status} ({key[:12]}, {fingerprint.rows} rows)")
+    metrics.MODEL_CACHE_REQUESTS.inc(status=status)
+    http_response.headers["X-Model-Cache"] = status
+    http_response.headers["X-Model-Id"] = key
+    http_response.headers["X-Training-Rows"] = str(len(df))
+    return forecast
+
+def reduce_data(df: pd.DataFrame, max_rows: int = 0, max_days: float = TRAIN_MAX_DAYS) -> pd.DataFrame:
+    """ Training data of a fit reduced with the TRAIN_* options, see reduction.reduce_training_data """
+    with span("reduce"):
+        return reduce_training_data(df, max_rows=max_rows, max_days=max_days,
+                                    full_resolution_days=TRAIN_FULL_RESOLUTION_DAYS,
+                                    coarse_interval=parse_duration(TRAIN_COARSE_INTERVAL))
+
+def json_response(content, http_response: Response = None) -> FastJSONResponse:
+    """ Response of the forecast endpoints. It is returned directly so FastAPI doesn't walk
+    the forecast with its jsonable_encoder, the headers set on http_response are kept.
+    """
+    return FastJSONResponse(content, headers=dict(http_response.headers) if http_response is not None else None)
+
+async def cached_model(key: str, fingerprint=None):
+    """ Return the CachedModel of key from the model cache or from disk, None if it is not found.
+    fingerprint: data of the request. With several workers, a model in memory trained with other
+    data is looked up on disk too, another worker may have stored the model of this data.
+    """
+    cached = model_cache.get(key)
+    outdated = shared and cached is not None and fingerprint is not None and cached.fingerprint != fingerprint
+    if (cached is None or outdated) and model_store is not None:
+        with span("store"):
+            stored = await asyncio.to_thread(model_store.get, key)
+        if stored is not None and (cached is None or stored.fingerprint == fingerprint):
+            logger.info(f"Model {key[:12]} loaded from disk")
+            cached = stored
+            model_cache.set(key, cached)
+    return cached
+
+async def cached_result(key: str, str_queries: list, compute, http_response: Response) -> dict:
+    """ Return the cached response of key or await compute() to build it.
+    A cached response is valid until the GROUP BY time(...) bucket of the queries rolls over
+    (new data may be available) or RESULT_CACHE_TTL expires. The X-Result-Cache response
+    header is hit, miss or shared (joined an identical request in progress).
+    The X-Model-Id and X-Training-Rows headers set by compute are cached with the response, a
+    response without a model of its own (e.g. a total summed from components) has no X-Model-Id.
+    """
+    intervals = [group_by_interval(q) for q in str_queries if q is not None]
+    intervals = [i for i in intervals if i is not None]
+    # The response changes when any of the queries gets a new bucket
+    bucket = tuple(time_bucket(interval, offset) for interval, offset in intervals)
+
+    cached = result_cache.get(key)
+    # The responses stored on disk by a previous version have no model id, they are computed again
+    if cached is not None and len(cached) == 4 and cached[0] == bucket:
+        status = "hit"
+        response, rows, model_id = cached[1], cached[2], cached[3]
+    else:
+        status = "shared" if single_flight.running(key) else "miss"
+
+        async def compute_and_store():
+            response = await compute()
+            rows = http_response.headers.get("X-Training-Rows")
+            model_id = http_response.headers.get("X-Model-Id")
+            result_cache.set(key, (bucket, response, rows, model_id))
+            return response, rows, model_id
+
+        response, rows, model_id = await single_flight.run(key, compute_and_store)
+    logger.info(f"Result cache {status} ({key[:12]})")
+    metrics.RESULT_CACHE_REQUESTS.inc(status=status)
+    http_response.headers["X-Result-Cache"] = status
+    if model_id is not None:
+        http_response.headers["X-Model-Id"] = model_id
+    if rows is not None:
+        http_response.headers["X-Training-Rows"] = rows
+    return response
+
+def validate_request(model, data):
+    """ Validate a request body (JSON bytes, parsed by pydantic-core) or query parameters """
+    try:
+        with span("parse"):
+            return model.model_validate_json(data) if isinstance(data, bytes) else model.model_validate(data)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False))
+
+@app.post("/forecast", openapi_extra={"requestBody": {"required": True, "content": {
+    "application/json": {"schema": {"$ref": "#/components/schemas/ForecastRequest"}},
+    PACKED_CONTENT_TYPE: {"schema": {"type": "string", "format": "binary"}},
+    ARROW_CONTENT_TYPES[0]: {"schema": {"type": "string", "format": "binary"}},
+}}})
+async def forecast_endpoint(http_request: Request, http_response: Response):
+    """ Forecast the data of the request. The body is a JSON ForecastRequest or, for binary
+    uploads, the data (see ingest.py) with the other fields as query parameters, e.g.
+    /forecast?futurePeriods=48&unit=ms with Content-Type application/octet-stream.
+    """
+    content_type = http_request.headers.get("content-type", "").split(";")[0].strip().lower()
+    body = await http_request.body()
+    df = None
+    if content_type == PACKED_CONTENT_TYPE or content_type in ARROW_CONTENT_TYPES:
+        request = validate_request(ForecastRequest, dict(http_request.query_params))
+        unit = http_request.query_params.get("unit", "s")
+        with span("dataframe"):
+            df = packed_frame(body, unit) if content_type == PACKED_CONTENT_TYPE else arrow_frame(body, unit)
+    else:
+        request = validate_request(ForecastRequest, body)
+    return json_response(await forecast(request, http_response, df), http_response)
+
+def request_frame(request: ForecastRequest) -> pd.DataFrame:
+    """ DataFrame with the columns 'ds' (without timezone) and 'y' of the data of a /forecast request """
     data = request.data
-    futurePeriods = request.futurePeriods
-    futureFreq = request.futureFreq
+    if isinstance(data, SeriesColumns):
+        with span("dataframe"):
+            return columns_frame(data.ds, data.y, data.unit)
 
     # Check that data is not empty
     if not data:
@@ -63,7 +565,8 @@ async def forecast(request: ForecastRequest):
         raise HTTPException(status_code=400, detail="No data provided")
 
     # Create the DataFrame with the received data
-    df = pd.DataFrame(data)
+    with span("dataframe"):
+        df = pd.DataFrame(data)
 
     # Validate that the DataFrame has exactly two columns
     if df.shape[1] != 2:
@@ -74,127 +577,197 @@ async def forecast(request: ForecastRequest):
     df.columns = ['ds', 'y']
 
     # Delocalize the dates
-    df['ds'] = pd.to_datetime(df['ds']).dt.tz_localize(None)
-
-    # Configure and train the Prophet model
-    model = Prophet()
-    model.fit(df)
-    future = model.make_future_dataframe(periods=futurePeriods, freq=futureFreq)
-    forecast = model.predict(future)
-    forecast = forecast[['ds', 'yhat']].tail(futurePeriods)
+    with span("dataframe"):
+        df['ds'] = pd.to_datetime(df['ds']).dt.tz_localize(None)
+    return df
+
+async def forecast(request: ForecastRequest, http_response: Response, df: pd.DataFrame = None):
+    """ Forecast the data of request, or df if the data was uploaded in binary """
+    futurePeriods = request.futurePeriods
+    futureFreq = request.futureFreq
+    if df is None:
+        df = request_frame(request)
+
+    # Train the Prophet model in the fit pool (the same data and profile get the same model)
+    profile = resolve_profile(request.profile)
+    key = cache_key("forecast", data_fingerprint(df).digest, profile, request.max_rows)
+    forecast = await cached_forecast(key, df, futurePeriods, futureFreq, http_response,
+                                     request.fast, request.interval, profile, request.max_rows)
     
-    # Convert dates to ISO format without timezone and create the output dictionary    
-    forecast['ds'] = forecast['ds'].dt.strftime('%Y-%m-%dT%H:%M:%S')
-    forecast = forecast.set_index('ds')
-    response = forecast.to_dict()['yhat']
- 
-    return response
+    # Dates in ISO format without timezone
+    return forecast_body(forecast, request.interval, request.format)
 
 @app.post("/query")
-async def query(request: QueryRequest):
+async def query_endpoint(request: QueryRequest, http_response: Response):
+    return json_response(await query(request, http_response), http_response)
+
+def check_row_budget(str_queries: list):
+    """ Reject the queries that would return more than QUERY_MAX_ROWS rows, estimated from their
+    GROUP BY time() and time bounds. The queries that can't be estimated are accepted.
+    """
+    if not QUERY_MAX_ROWS:
+        return
+    for str_query in str_queries:
+        rows = estimated_rows(str_query)
+        if rows is not None and rows > int(QUERY_MAX_ROWS):
+            logger.error(f"Query of about {rows} rows over the budget of {QUERY_MAX_ROWS}: {str_query}")
+            raise HTTPException(status_code=400, detail=f"The query would return about {rows} rows, more than "
+                                f"QUERY_MAX_ROWS ({QUERY_MAX_ROWS}). Use a larger bucket or a shorter time range")
+
+def influx_source(request) -> tuple:
+    """ InfluxDB server, database and credentials of a request, part of the keys of its caches.
+    Another user may not be allowed to read the same series, only a hash of the password is kept.
+    """
+    password = hashlib.sha256(request.influx_password.encode()).hexdigest()
+    return (request.influx_host, request.influx_port, request.influx_dbname, request.influx_user, password)
+
+async def query(request: QueryRequest, http_response: Response):
+    check_row_budget([request.str_query])
+    key = cache_key("query", *influx_source(request), request.str_query, request.futurePeriods,
+                    request.futureFreq, request.max_points, request.fast, request.interval,
+                    resolve_profile(request.profile), request.max_rows, request.format)
+    return await cached_result(key, [request.str_query], lambda: query_forecast(request, http_response), http_response)
+
+def query_model_key(request: QueryRequest) -> str:
+    """ Key of the model of a /query request in the model cache """
+    return cache_key("query", *influx_source(request), request.str_query, request.max_points,
+                     resolve_profile(request.profile), request.max_rows)
+
+async def query_frame(request: QueryRequest) -> pd.DataFrame:
+    """ DataFrame with the columns 'ds' (UTC without timezone) and 'y' of the result of str_query """
     str_query = request.str_query
     host=request.influx_host
     port=request.influx_port
     user = request.influx_user
     password = request.influx_password
     dbname = request.influx_dbname
-    futurePeriods = request.futurePeriods
-    futureFreq = request.futureFreq
 
     try:
         # Connect to InfluxDB
         logger.debug(f"Executing query: {str_query}")
-        client = InfluxDBClient(host=host, port=port, username=user, password=password, database=dbname)
+        # In a thread, get() may ping an idle client
+        client = await asyncio.to_thread(influx_pool.get, host, port, user, password, dbname)
         logger.debug("Connected to InfluxDB")
 
-        # Execute the query
-        result = client.query(str_query)
+        # Execute the query without blocking the event loop. The chunks of the response
+        # are parsed into numpy arrays as they arrive (dates in UTC without timezone)
+        try:
+            with span("influx"):
+                times, values = await asyncio.to_thread(query_arrays, client, str_query, int(INFLUXDB_CHUNK_SIZE),
+                                                        request.max_points, True)
+        except ValueError as e:
+            # Validate that the result has exactly two columns
+            logger.error(f"Invalid query result: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
         logger.debug("Query executed successfully")
 
-        # Convert the result to a DataFrame
-        points = list(result.get_points())
-        if not points:
+        if len(times) == 0:
             logger.error("No data returned from query")
             raise HTTPException(status_code=400, detail="No data returned from query")
 
-        df = pd.DataFrame(points) # Get dates in UTC
-        logger.debug("DataFrame created successfully")
-
-        # Validate that the DataFrame has exactly two columns
-        if df.shape[1] != 2:
-            logger.error("Data must have exactly two columns: 'ds' and 'y'")
-            raise HTTPException(status_code=400, detail="Expected two columns 'time' and the query value")
-
-        # Assign names to the columns
-        df.columns = ['ds', 'y']
+        df = pd.DataFrame({'ds': times, 'y': values})
+        logger.debug(f"DataFrame created successfully ({len(df)} rows)")
+        return df
 
-        # Delocalize the dates
-        df['ds'] = pd.to_datetime(df['ds']).dt.tz_localize(None)
+    except HTTPException:
+        raise
+    except (ConnectionError, requests.exceptions.ConnectionError):
+        logger.error("Failed to connect to InfluxDB")
+        influx_pool.evict(host, port, user, dbname)
+        raise HTTPException(status_code=500, detail="Failed to connect to InfluxDB")
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # Configure and train the Prophet model
-        model = Prophet()
-        model.fit(df)
-        future = model.make_future_dataframe(periods=futurePeriods, freq=futureFreq)
-        forecast = model.predict(future)
-        forecast=forecast.tail(futurePeriods)
+async def query_forecast(request: QueryRequest, http_response: Response) -> dict:
+    futurePeriods = request.futurePeriods
+    futureFreq = request.futureFreq
+    df = await query_frame(request)
 
-        forecast['ds'] = pd.to_datetime(forecast['ds']).dt.tz_localize('UTC')
-        forecast = forecast.set_index('ds')
-        response = forecast.to_dict()['yhat']        
+    try:
+        # Train the Prophet model in the fit pool
+        key = query_model_key(request)
+        forecast = await cached_forecast(key, df, futurePeriods, futureFreq, http_response,
+                                         request.fast, request.interval, resolve_profile(request.profile),
+                                         request.max_rows, utc=True)
 
-        return response
+        # Dates in ISO format in UTC
+        return forecast_body(forecast, request.interval, request.format, utc=True)
     
-    except ConnectionError:
-        logger.error("Failed to connect to InfluxDB")
-        raise HTTPException(status_code=500, detail="Failed to connect to InfluxDB")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"An error occurred: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-async def delta_energy_dataframe(points) -> pd.DataFrame:
-    """ The query must have GROUP BY time('time(1h)'). Normally h but can be changed to other time intervals.
-    points come in UTC timezone.
+def energy_query_arrays(client, connection: tuple, str_query: str, n: int) -> tuple:
+    """ Execute the energy query number n and return its (times, delta_energy) arrays.
+    Blocking, it runs in a thread so the queries of a request are executed in parallel.
+    connection: influx_source of the request, it identifies the query in the history store.
+    Return None if an optional query (n > 1) has no points.
     """
+    def run_query(query: str) -> tuple:
+        # Execute the query, its chunks are converted to numpy arrays as they arrive
+        return query_arrays(client, query, int(INFLUXDB_CHUNK_SIZE)) # Get dates in UTC
+
     try:
-        df = pd.DataFrame(points)
-        
-        if 'time' not in df.columns:
-            logger.error("No 'time' column in the data")
-            raise ValueError("Column 'time' not found in the input data")
-        
-        df['time'] = pd.to_datetime(df['time']).dt.tz_localize(None) # Eliminate the timezone for Prophet
-        
-        # Convert time to the index of the DataFrame
-        df.set_index('time', inplace=True)
-        
-        if df.empty:
-            raise ValueError("DataFrame is empty after setting 'time' as index")
-        
-        # Create a new column that calculates the hourly energy difference
-        df['delta_energy'] = df.iloc[:,0].diff() # Calculate the difference between consecutive values
-        df = df.drop(df.index[0]) # Remove the first row of the DataFrame (the hourly difference of the first record does not make sense)
-        df = df.drop(df.index[-1]) # Remove the last row of the DataFrame (there isn´t enough data yet in the last hour)
-                
-        # If there has been any counter reset, the difference will be negative
-        mask = df['delta_energy'] < 0
-        # The next line is replaced because Prophet can manage perfectly the NaN values
-        # df.loc[mask, 'delta_energy'] = 0 # In those cases, set the difference to 0
-        df.loc[mask, 'delta_energy'] = np.nan # In those cases, set the difference to NaN
-        
-        return df
-    
+        with span("influx"):
+            if history_store is not None:
+                times, values = history_store.query(connection, str_query, run_query)
+            else:
+                times, values = run_query(str_query)
     except Exception as e:
-        logger.error(f"Error processing delta_energy_dataframe: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error("Failed to connect to InfluxDB")
+        raise HTTPException(status_code=400, detail=f"Error executing query{n}: {str(e)}")
+
+    if len(times) == 0:
+        if n == 1:
+            logger.error("No data returned from query1")
+            raise HTTPException(status_code=400, detail="No data returned from query1")
+        logger.warning(f"Query_{n} has not points")
+        return None
+    try:
+        with span("energy"):
+            series = delta_energy(times, values)
+        logger.debug(f"Query_{n} delta_energy executed successfully")
+        return series
+    except Exception as e:
+        logger.error(f"Error processing dataframes in query{n}: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Error processing query{n}")
 
 
 @app.post("/energy_queries")
-async def query(request: EnergyQueryRequest):
+async def energy_queries_endpoint(request: EnergyQueryRequest, http_response: Response):
     """ Post a query to the InfluxDB database for cumulatively accounted energy 
     and return the forecast results using Prophet."""
-    str_query1 = request.str_query1
-    str_query2 = request.str_query2
+    return json_response(await energy_queries(request, http_response), http_response)
+
+async def energy_queries(request: EnergyQueryRequest, http_response: Response):
+    str_queries = energy_query_strings(request)
+    check_row_budget(str_queries)
+    key = cache_key("energy_queries", *influx_source(request), str_queries, request.futurePeriods,
+                    request.futureFreq, request.fast, request.interval, resolve_profile(request.profile),
+                    request.max_rows, request.format,
+                    *((request.components, request.total) if request.components else ()))
+    return await cached_result(key, str_queries, lambda: energy_forecast(request, http_response), http_response)
+
+def energy_model_key(request: EnergyQueryRequest, str_queries: list = None) -> str:
+    """ Key of the model of an /energy_queries request in the model cache.
+    str_queries: the queries of the model, all the queries of the request by default. The model of
+    one component has the key of a request with only its query, they share the model.
+    """
+    if str_queries is None:
+        str_queries = energy_query_strings(request)
+    return cache_key("energy_queries", *influx_source(request), str_queries,
+                     resolve_profile(request.profile), request.max_rows)
+
+def energy_query_strings(request: EnergyQueryRequest) -> list:
+    """ str_query1, the optional str_query2 and the extra str_queries of the request """
+    return [q for q in [request.str_query1, request.str_query2, *request.str_queries] if q is not None]
+
+async def energy_forecast(request: EnergyQueryRequest, http_response: Response) -> dict:
+    str_queries = energy_query_strings(request)
     host = request.influx_host
     port = request.influx_port
     user = request.influx_user
@@ -203,74 +776,44 @@ async def query(request: EnergyQueryRequest):
     futurePeriods = request.futurePeriods
     futureFreq = request.futureFreq
 
-    # Check that the query has the groupby('time(1h)') clause
-    if 'GROUP BY TIME(' not in str_query1.upper():
-        logger.error("The query must have GROUP BY time('time(1h)')")
-        raise HTTPException(status_code=400, detail="The query must have GROUP BY time('time(1h)')")
-    if str_query2 is not None and 'GROUP BY TIME(' not in str_query2.upper():
-        logger.error("The query must have GROUP BY time('time(1h)')")
-        raise HTTPException(status_code=400, detail="The query must have GROUP BY time('time(1h)')")
+    # Check that the queries have the groupby('time(1h)') clause
+    for str_query in str_queries:
+        if 'GROUP BY TIME(' not in str_query.upper():
+            logger.error("The query must have GROUP BY time('time(1h)')")
+            raise HTTPException(status_code=400, detail="The query must have GROUP BY time('time(1h)')")
     try:
         # Connect to InfluxDB
-        client = InfluxDBClient(host=host, port=port, username=user, password=password, database=dbname)
+        client = await asyncio.to_thread(influx_pool.get, host, port, user, password, dbname)
         logger.debug("Connected to InfluxDB step 1")
 
     except Exception as e:
         logger.error("Failed to connect to InfluxDB")
         raise HTTPException(status_code=400, detail=f"Error connecting to InfluxDB step 1: {str(e)}")
-    
+
+    # Execute all the queries (and their DataFrame conversions) at the same time
     try:
-        # Execute the query
-        result = client.query(str_query1)
-        logger.debug("Query_1 executed successfully")
-        # Convert the result to a DataFrame
-        points = list(result.get_points()) # Get dates in UTC
-    except Exception as e:
-        logger.error("Failed to connect to InfluxDB")
-        raise HTTPException(status_code=400, detail=f"Error executing query1: {str(e)}")
+        series = await asyncio.gather(*[asyncio.to_thread(energy_query_arrays, client, influx_source(request), str_query, n)
+                                        for n, str_query in enumerate(str_queries, start=1)])
+    except HTTPException as e:
+        # __context__ is the exception of the InfluxDB client that caused the error
+        if isinstance(e.__context__, requests.exceptions.ConnectionError):
+            influx_pool.evict(host, port, user, dbname)
+        raise
+    components = [(q, s) for q, s in zip(str_queries, series) if s is not None]
+    series = [s for s in series if s is not None] # Optional queries without points are ignored
+    if request.components:
+        return await energy_components_forecast(request, components, http_response)
 
-    
-    if not points:
-        logger.error("No data returned from query1")
-        raise HTTPException(status_code=400, detail="No data returned from query1")
     try:
-        df1 = await delta_energy_dataframe(points)
-        logger.debug("Query_1 delta_energy_dataframe executed successfully")               
-    except:
-        logger.error("Error processing dataframes in query1")
-        raise HTTPException(status_code=400, detail="Error processing query1")    
-    # Optional second query
-    if str_query2 is not None:
-        result = client.query(str_query2)
-        logger.debug("Query_2 executed successfully")
-
-        # Convert the result to a DataFrame
-        points = list(result.get_points())
-        if not points:
-            # raise HTTPException(status_code=400, detail="No data returned from query2")
-            logger.warning("Query_2 has not points")
-            df = df1
-            df.reset_index(inplace=True)
-        else:
-            logger.debug("Query_2 has points")
-            try:
-                df2 = await delta_energy_dataframe(points)
-                logger.debug("Query_2 delta_energy_dataframe executed successfully")
-                # Merge DataFrames
-                df = pd.merge(df1, df2, left_index=True, right_index=True, how='outer')
-                logger.debug("df = pd.merge(df1, df2, left_index=True, right_index=True, how='outer') OK")
-                # The next line is replaced because Prophet can manage perfectly the NaN values
-                # df['delta_energy'] = df['delta_energy_x'].fillna(0) + df['delta_energy_y'].fillna(0) # Sum the columns and fill NaN with the present values
-                df['delta_energy'] = df['delta_energy_x'] + df['delta_energy_y'] # Sum the columns
-                df.reset_index(inplace=True)             
-                df = df[['time', 'delta_energy']]
-                logger.debug("df = df[['time', 'delta_energy']] OK")
-            except Exception as e:
-                logger.error(f"Error processing dataframes in query2: {str(e)}")
-                raise HTTPException(status_code=400, detail=f"Error processing query2: {str(e)}")             
-    else:
-        df = df1
-        df.reset_index(inplace=True)
+        # Sum the energy of all the queries on their aligned timestamps
+        with span("energy"):
+            times, delta = sum_delta_energy(series)
+        df = pd.DataFrame({'time': times, 'delta_energy': delta})
+        logger.debug(f"Merged the delta energy of {len(series)} queries")
+    except Exception as e:
+        logger.error(f"Error processing dataframes: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Error processing dataframes: {str(e)}")
+
     # Validate that the DataFrame is not empty
     if df is None or df.empty:
         logger.error("Error processing dataframes")
@@ -288,26 +831,330 @@ async def query(request: EnergyQueryRequest):
         # Delocalize the dates
         # df['ds'] = pd.to_datetime(df['ds']).dt.tz_localize(None) # Se ha hecho en delta_energy_dataframe
 
-        # Configure and train the Prophet model
-        model = Prophet()
-        model.fit(df)
-        future = model.make_future_dataframe(periods=futurePeriods, freq=futureFreq)
-        forecast = model.predict(future)
-        forecast=forecast.tail(futurePeriods)
+        # Train the Prophet model in the fit pool
+        key = energy_model_key(request)
+        forecast = await cached_forecast(key, df, futurePeriods, futureFreq, http_response,
+                                         request.fast, request.interval, resolve_profile(request.profile),
+                                         request.max_rows, utc=True)
+
+        # Dates in ISO format in UTC
+        return forecast_body(forecast, request.interval, request.format, utc=True)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing Prophet model: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 
-        # Convert dates to ISO format with timezone and create the output dictionary
-        forecast['ds'] = pd.to_datetime(forecast['ds']).dt.tz_localize('UTC')
-        forecast = forecast.set_index('ds')
-        response = forecast.to_dict()['yhat'] 
+async def energy_components_forecast(request: EnergyQueryRequest, components: list, http_response: Response) -> dict:
+    """ Forecast of the total energy and of every query on its own, from the series of the
+    queries downloaded once. components: (str_query, (times, delta_energy)) of the queries with points.
+    The models are fitted in parallel in the fit pool, each one with the key of a request with only
+    its query, so they are shared with those requests. The total is fitted with the key of the
+    request without components (total "fit"), it is the model of the only component if there is
+    one, or the sum of the component forecasts on their common dates (total "sum", no fit).
+    Return {"total": {...}, "components": [{"query": ..., "model_id": ..., "forecast": ...}]}.
+    """
+    profile = resolve_profile(request.profile)
+
+    async def fit(key: str, times: np.ndarray, delta: np.ndarray, response: Response) -> pd.DataFrame:
+        df = pd.DataFrame({'ds': times, 'y': delta})
+        return await cached_forecast(key, df, request.futurePeriods, request.futureFreq, response,
+                                     request.fast, request.interval, profile, request.max_rows, utc=True)
 
-        return response
+    keys = [energy_model_key(request, [str_query]) for str_query, _ in components]
+    fit_total = request.total == "fit" and len(components) > 1
+    # The headers of the response (X-Model-Id) are the ones of the model of the total, if it has one
+    responses = [http_response if len(components) == 1 else Response() for _ in components]
+    jobs = [fit(key, times, delta, response)
+            for key, (_, (times, delta)), response in zip(keys, components, responses)]
+    if fit_total:
+        with span("energy"):
+            times, delta = sum_delta_energy([s for _, s in components])
+        jobs.append(fit(energy_model_key(request), times, delta, http_response))
+    try:
+        forecasts = await asyncio.gather(*jobs)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing Prophet model: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+    if fit_total:
+        total, total_id = forecasts.pop(), energy_model_key(request)
+    elif len(components) == 1:
+        total, total_id = forecasts[0], keys[0]
+    else:
+        indexed = [forecast.set_index('ds') for forecast in forecasts]
+        common = reduce(lambda a, b: a.intersection(b), [forecast.index for forecast in indexed])
+        total, total_id = sum(forecast.loc[common] for forecast in indexed).reset_index(), None
+    return {"total": {"model_id": total_id, "forecast": forecast_body(total, request.interval, request.format, utc=True)},
+            "components": [{"query": str_query, "model_id": key,
+                            "forecast": forecast_body(forecast, request.interval, request.format, utc=True)}
+                           for (str_query, _), key, forecast in zip(components, keys, forecasts)]}
+
+@app.post("/predict")
+async def predict_model(request: PredictRequest):
+    """ Forecast with a model fitted by a previous request, without fitting it again.
+    The dates are futurePeriods of futureFreq after the training data, or the given timestamps.
+    """
+    cached = await cached_model(request.model_id)
+    if cached is None:
+        logger.error(f"Model {request.model_id} not found")
+        raise HTTPException(status_code=404, detail="Model not found, it may have been evicted from the cache")
+
+    if request.timestamps is not None:
+        if not request.timestamps:
+            raise HTTPException(status_code=400, detail="No timestamps provided")
+        try:
+            # Dates with a timezone are converted to UTC for the InfluxDB models, the models of
+            # /forecast were trained on the local time of their data, its offset is only dropped
+            dates = pd.Series([pd.Timestamp(t) for t in request.timestamps])
+            if cached.utc:
+                dates = dates.map(lambda t: t.tz_convert('UTC').tz_localize(None) if t.tzinfo else t)
+            else:
+                dates = dates.map(lambda t: t.tz_localize(None) if t.tzinfo else t)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid timestamps: {e}")
+        forecast = await fit_pool.run(predict_dates, cached.model, dates, request.fast, request.interval)
+    else:
+        forecast = await fit_pool.run(predict, cached.model, request.futurePeriods, request.futureFreq,
+                                      request.fast, request.interval)
+    logger.info(f"Prediction of model {request.model_id[:12]} ({len(forecast)} rows)")
+
+    return json_response(forecast_body(forecast, request.interval, request.format, utc=cached.utc))
+
+def metrics_body(performance: pd.DataFrame) -> dict:
+    """ Columns of the performance metrics of a backtest, the horizons as Timedelta strings """
+    if performance is None:
+        return {}
+    body = {"horizon": [str(horizon) for horizon in performance['horizon']]}
+    for column in performance.columns.drop('horizon'):
+        body[column] = performance[column].to_numpy(dtype=float).tolist()
+    return body
+
+@app.post("/backtest")
+async def backtest(request: BacktestRequest):
+    """ Cross-validate model configurations on the same data: for every cutoff, fit the data
+    before it and forecast the horizon after it, then compute MAE, RMSE and MAPE per horizon
+    with prophet.diagnostics. The cutoffs are fitted in parallel in the fit pool as bulk jobs
+    and their forecasts are cached, so a backtest can be repeated with more configurations.
+    Every configuration reports its wall-clock time and the seconds of its fits.
+    """
+    try:
+        horizon = pd.Timedelta(request.horizon)
+        initial = pd.Timedelta(request.initial) if request.initial else 3 * horizon
+        period = pd.Timedelta(request.period) if request.period else horizon / 2
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid horizon, initial or period: {e}")
+    if horizon <= pd.Timedelta(0) or period <= pd.Timedelta(0):
+        raise HTTPException(status_code=400, detail="horizon and period must be positive")
+    if request.max_cutoffs < 1:
+        raise HTTPException(status_code=400, detail="max_cutoffs must be at least 1")
+
+    if request.data is not None:
+        df = request_frame(request)
+    else:
+        check_row_budget([request.str_query])
+        df = await query_frame(request)
+    df = df.dropna(subset=['y']).sort_values('ds', ignore_index=True)
+    fit_priority.set("bulk")
+    start = time.perf_counter()
+    try:
+        cutoffs = (await fit_pool.run(backtest_cutoffs, df['ds'], horizon, initial, period))[-request.max_cutoffs:]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    digest = data_fingerprint(df).digest
+    # At most one cutoff per worker at a time, like the batches, so a backtest doesn't fill the queue
+    semaphore = asyncio.Semaphore(fit_pool.max_workers)
+
+    async def run_cutoff(cutoff, profile: dict, config: BacktestConfig) -> tuple:
+        key = cache_key("backtest", digest, cutoff, horizon, profile, config.max_rows, config.max_days)
+        cached = backtest_cache.get(key)
+        if cached is not None:
+            return cached, True
+        history = reduce_data(df[df['ds'] <= cutoff], config.max_rows, config.max_days)
+        test = df[(df['ds'] > cutoff) & (df['ds'] <= cutoff + horizon)]
+        async with semaphore:
+            result = await fit_pool.run(backtest_cutoff, history, test, cutoff, profile)
+        backtest_cache.set(key, result)
+        return result, False
+
+    configs = []
+    for n, config in enumerate(request.configs, start=1):
+        profile = resolve_profile(config.profile)
+        name = config.name or (config.profile if isinstance(config.profile, str) else None) or f"config{n}"
+        config_start = time.perf_counter()
+        try:
+            results = await asyncio.gather(*[run_cutoff(cutoff, profile, config) for cutoff in cutoffs])
+            cv = pd.concat([forecast for (forecast, _), _ in results], ignore_index=True)
+            performance = await fit_pool.run(backtest_metrics, cv, request.rolling_window)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Backtest of {name} failed: {e}")
+            raise HTTPException(status_code=500, detail=f"Backtest of {name} failed: {e}")
+        configs.append({"name": name, "profile": profile, "max_rows": config.max_rows, "max_days": config.max_days,
+                        "wall_seconds": round(time.perf_counter() - config_start, 3),
+                        "fit_seconds": round(sum(seconds for (_, seconds), _ in results), 3),
+                        "cached_cutoffs": sum(cached for _, cached in results),
+                        "metrics": metrics_body(performance)})
+        logger.info(f"Backtest of {name}: {len(cutoffs)} cutoffs in {configs[-1]['wall_seconds']} s")
+
+    return json_response({"rows": len(df), "horizon": str(horizon), "cutoffs": iso_strings(cutoffs),
+                          "wall_seconds": round(time.perf_counter() - start, 3), "configs": configs})
+
+async def run_batch(items: list, handler) -> list:
+    """ Run handler(item, http_response) for every item of a batch request.
+    The items are fitted in parallel, at most one per worker of the fit pool at a time so a
+    batch doesn't fill the queue of the pool. They are bulk jobs, the interactive requests
+    go first. The error of an item is reported in its result instead of failing the whole batch.
+    """
+    if not items:
+        logger.error("Empty batch request")
+        raise HTTPException(status_code=400, detail="No series provided")
+    fit_priority.set("bulk")
+    semaphore = asyncio.Semaphore(fit_pool.max_workers)
+
+    async def run_item(item):
+        async with semaphore:
+            try:
+                http_response = Response()
+                forecast = await handler(item, http_response)
+                return {"status": 200, "model_id": http_response.headers.get("X-Model-Id"), "forecast": forecast}
+            except HTTPException as e:
+                return {"status": e.status_code, "error": e.detail}
+            except Exception as e:
+                logger.error(f"Error processing batch item: {e}")
+                return {"status": 500, "error": str(e)}
+
+    return await asyncio.gather(*[run_item(item) for item in items])
+
+@app.post("/forecast/batch")
+async def forecast_batch(request: ForecastBatchRequest):
+    """ Forecast many series in one call. Return a list with the result of every series """
+    return json_response(await run_batch(request.series, forecast))
+
+@app.post("/query/batch")
+async def query_batch(request: QueryBatchRequest):
+    """ Batch version of /query. Return a list with the result of every query """
+    return json_response(await run_batch(request.queries, query))
+
+@app.post("/energy_queries/batch")
+async def energy_queries_batch(request: EnergyQueryBatchRequest):
+    """ Batch version of /energy_queries. Return a list with the result of every request """
+    return json_response(await run_batch(request.queries, energy_queries))
+
+def forecast_jobs(configs: list) -> list:
+    """ Create the ForecastJob of every job of options.json. A job has a name, the endpoint that
+    computes it (query or energy_queries), an interval in seconds or a cron expression and the
+    fields of the request of the endpoint (str_query, str_query1, futurePeriods...).
+    The runs of the jobs are staggered FORECAST_JOBS_STAGGER seconds apart.
+    """
+    jobs = []
+    for config in configs:
+        config = dict(config)
+        name = config.pop("name", None)
+        endpoint = config.pop("endpoint", None)
+        interval = config.pop("interval", None)
+        cron = config.pop("cron", None)
+        if "uncertainty" in config:
+            # interval is the schedule of the job, the interval field of the request is uncertainty
+            config["interval"] = config.pop("uncertainty")
+        try:
+            if endpoint not in JOB_ENDPOINTS:
+                raise ValueError(f"endpoint must be one of {', '.join(JOB_ENDPOINTS)}")
+            if isinstance(interval, bool):
+                raise ValueError("interval must be the seconds between runs, the uncertainty interval is uncertainty")
+            request_model, _ = JOB_ENDPOINTS[endpoint]
+            jobs.append(ForecastJob(name, endpoint, request_model(**config), interval=interval, cron=cron,
+                                    offset=len(jobs) * FORECAST_JOBS_STAGGER))
+        except Exception as e:
+            logger.error(f"Invalid forecast job {name}: {e}")
+    return jobs
+
+async def run_forecast_job(job: ForecastJob) -> dict:
+    """ Compute the forecast of a job with the handler of its endpoint """
+    _, handler = JOB_ENDPOINTS[job.endpoint]
+    timings = Timings()
+    current_timings.set(timings)
+    fit_priority.set("bulk")
+    result = await handler(job.request, Response())
+    logger.debug(f"Forecast job {job.name} timings: {timings.header()}")
+    return result
+
+# Endpoints that can compute a forecast job: request model and handler
+JOB_ENDPOINTS = {
+    "query": (QueryRequest, query),
+    "energy_queries": (EnergyQueryRequest, energy_queries),
+}
+
+@app.get("/forecasts")
+async def forecasts():
+    """ Status of the background forecast jobs """
+    scheduler.refresh()
+    return [job.status() for job in scheduler.jobs.values()]
+
+@app.get("/forecasts/{job}")
+async def forecast_job(job: str):
+    """ Latest forecast of a background job, with its age in seconds """
+    scheduler.refresh()
+    forecast_job = scheduler.jobs.get(job)
+    if forecast_job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown forecast job {job}")
+    if forecast_job.result is None:
+        raise HTTPException(status_code=503, detail=f"Forecast job {job} has not been computed yet",
+                            headers={"Retry-After": str(FORECAST_JOBS_STAGGER)})
+    return {**forecast_job.status(), "forecast": forecast_job.result}
+
+@app.get("/health")
+async def health():
+    """ Liveness: the API is up, it answers as soon as the server is started """
+    return {"status": "ok"}
+
+@app.get("/ready")
+async def ready():
+    """ Readiness: the warm-up of the fit pool is done and the forecasts don't pay the
+    loading of Prophet. 503 with Retry-After until then.
+    """
+    if not warmup_status["ready"]:
+        raise HTTPException(status_code=503, detail="Warming up", headers={"Retry-After": "5"})
+    return warmup_status
+
+@app.get("/fit_pool")
+async def fit_pool_state():
+    """ Workers of the fit pool, jobs running and queued by priority, and the Retry-After a
+    rejected request would get now
+    """
+    return fit_pool.state()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """ Metrics of the addon in the Prometheus text format """
+    metrics.FIT_POOL_WORKERS.set(fit_pool.max_workers)
+    metrics.FIT_POOL_RUNNING.set(fit_pool.running)
+    for priority, queued in fit_pool.state()["queued"].items():
+        metrics.FIT_POOL_QUEUED.set(queued, priority=priority)
+    metrics.FIT_POOL_UTILIZATION.set(fit_pool.running / fit_pool.max_workers)
+    for cache, counter, hits in [("model", metrics.MODEL_CACHE_REQUESTS, ["hit"]),
+                                 ("result", metrics.RESULT_CACHE_REQUESTS, ["hit", "shared"])]:
+        total = counter.total()
+        if total:
+            metrics.CACHE_HIT_RATIO.set(sum(counter.value(status=s) or 0 for s in hits) / total, cache=cache)
+    metrics.CACHE_ENTRIES.set(len(model_cache), cache="model")
+    metrics.CACHE_ENTRIES.set(len(result_cache), cache="result")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 if __name__ == '__main__':
     import uvicorn
-    logger.info(f"Starting the FastAPI server on port 5000...")
-    uvicorn.run(app, host='0.0.0.0', port=5000)
+    port = int(os.getenv("PORT", 5000)) # The addon always listens on 5000, PORT is for the benchmarks
+    if WORKERS > 1:
+        # uvicorn starts the workers, each one imports main:app (run.sh does the same)
+        logger.info(f"Starting the FastAPI server on port {port} with {WORKERS} workers...")
+        os.execvp(sys.executable, [sys.executable, "-m", "uvicorn", "main:app", "--app-dir",
+                                   os.path.dirname(os.path.abspath(__file__)), "--host", "0.0.0.0",
+                                   "--port", str(port), "--workers", str(WORKERS)])
+    logger.info(f"Starting the FastAPI server on port {port}...")
+    uvicorn.run(app, host='0.0.0.0', port=port)
     logger.info("FastAPI server started successfully.")    
@@ -0,0 +1,182 @@
+""" Timing of the stages of the requests and aggregated metrics in Prometheus format.
+Every request gets a Timings object in a context variable. The stages of the pipeline
+(InfluxDB query, parsing, DataFrame conversion, fit, predict, serialization...) are
+wrapped in span(name), their durations are returned in the Server-Timing header of the
+response and observed in the stage histogram. The context variable is copied to the
+threads of asyncio.to_thread, and the fit pool sends back the spans of its workers.
+The metrics are exposed on /metrics in the Prometheus text format. They are implemented
+here because the base image of the addon has no Prometheus client library.
+"""
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Buckets of the histograms of durations in seconds and of rows
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+ROWS_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000)
+
+
+class Timings:
+    """ Durations of the stages of a request, in seconds. A stage executed several times
+    (e.g. the parallel queries of /energy_queries) accumulates its durations.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = {}
+        self._lock = threading.Lock()  # Spans are added by the threads of asyncio.to_thread
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def header(self) -> str:
+        """ Value of the Server-Timing header, durations in milliseconds """
+        spans = dict(self.spans, total=time.perf_counter() - self.start)
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in spans.items())
+
+
+current_timings = contextvars.ContextVar('current_timings', default=None)
+
+
+def record(name: str, seconds: float):
+    """ Add a stage duration to the timings of the current request and to the stage histogram """
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+    STAGE_SECONDS.observe(seconds, stage=name)
+
+
+@contextmanager
+def span(name: str):
+    """ Time the stage name of the current request """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """ Base of the metrics: a value per combination of the label values """
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}  # Tuple of label values -> value
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def value(self, **labels):
+        """ Current value of the labels, None if it was never set """
+        return self._values.get(self._key(labels))
+
+    def samples(self) -> list:
+        """ (name suffix, label names, label values, value) of every sample """
+        with self._lock:
+            return [("", self.labels, key, value) for key, value in sorted(self._values.items())]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_labels(names, values)} {_number(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self) -> float:
+        """ Sum of the values of all the labels """
+        with self._lock:
+            return sum(self._values.values())
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = SECONDS_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self) -> list:
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append(("_bucket", self.labels + ("le",), key + (_number(bound),), count))
+                samples.append(("_sum", self.labels, key, total))
+                samples.append(("_count", self.labels, key, counts[-1]))
+        return samples
+
+
+REGISTRY = []
+
+
+def render() -> str:
+    """ All the metrics in the Prometheus text format """
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+REQUEST_SECONDS = Histogram("prophet_request_duration_seconds", "Duration of the requests", ("path", "status"))
+STAGE_SECONDS = Histogram("prophet_stage_duration_seconds",
+                          "Duration of the stages of the requests (influx, parse, fit, predict...)", ("stage",))
+TRAINING_ROWS = Histogram("prophet_training_rows", "Rows of the training data of the fitted models",
+                          buckets=ROWS_BUCKETS)
+MODEL_CACHE_REQUESTS = Counter("prophet_model_cache_requests_total", "Lookups of the model cache by result",
+                               ("status",))
+RESULT_CACHE_REQUESTS = Counter("prophet_result_cache_requests_total", "Lookups of the result cache by result",
+                                ("status",))
+CACHE_HIT_RATIO = Gauge("prophet_cache_hit_ratio", "Hits over lookups of the caches since the start", ("cache",))
+CACHE_ENTRIES = Gauge("prophet_cache_entries", "Entries of the in-memory caches", ("cache",))
+FIT_POOL_WORKERS = Gauge("prophet_fit_pool_workers", "Worker processes of the fit pool")
+FIT_POOL_RUNNING = Gauge("prophet_fit_pool_running", "Jobs running in the fit pool")
+FIT_POOL_QUEUED = Gauge("prophet_fit_pool_queued", "Jobs waiting for a free worker of the fit pool by priority",
+                        ("priority",))
+FIT_POOL_UTILIZATION = Gauge("prophet_fit_pool_utilization", "Running jobs over workers of the fit pool")
+FIT_POOL_REJECTED = Counter("prophet_fit_pool_rejected_total",
+                            "Jobs rejected by the fit pool, with the queue full or shed for interactive jobs",
+                            ("priority", "reason"))
+FIT_POOL_BUSY_SECONDS = Counter("prophet_fit_pool_busy_seconds_total",
+                                "Seconds spent by the workers of the fit pool running jobs")
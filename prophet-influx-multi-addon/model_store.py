@@ -0,0 +1,75 @@
+""" Fitted models persisted under /data, so they survive the restarts of the addon.
+After a restart (HA update, reboot, change of the options) the in-memory model cache is
+empty and every request would fit its model from scratch at the same time. The models
+are also written to disk with the fingerprint of their training data and loaded lazily
+by the first request of their key, which can then predict directly or warm-start the refit.
+"""
+import logging
+import os
+import pickle
+import re
+from importlib.metadata import version
+from files import atomic_write, prune_lru
+
+logger = logging.getLogger(__name__)
+
+# Bumped when the format of the files changes, older files are ignored
+STORE_VERSION = 1
+# The keys are the sha1 of cache_key, anything else (e.g. a model_id with "../") is not a file of the store
+KEY_RE = re.compile(r'[0-9a-f]{40}')
+
+
+class ModelStore:
+    """ CachedModel objects stored in directory, one pickle file per key.
+    max_bytes: size of the whole store, the least recently used models are removed.
+    The files record the Prophet version, a model pickled by another version is ignored.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 200 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.prophet_version = version('prophet')
+
+    def _path(self, key: str) -> str:
+        if not KEY_RE.fullmatch(key):
+            raise ValueError(f"Invalid model key {key!r}")
+        return os.path.join(self.directory, f"{key}.pkl")
+
+    def get(self, key: str):
+        """ Return the CachedModel stored for key or None """
+        if not KEY_RE.fullmatch(key):
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                stored = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Invalid stored model {key[:12]}, removing it: {e}")
+            self._remove(key)
+            return None
+        if stored.get('version') != STORE_VERSION or stored.get('prophet') != self.prophet_version:
+            logger.info(f"Stored model {key[:12]} was saved by another version, ignoring it")
+            self._remove(key)
+            return None
+        os.utime(path)  # Last use, for the pruning of the store
+        return stored['cached']
+
+    def set(self, key: str, cached):
+        """ Store a CachedModel. Blocking, it is called in a thread. """
+        os.makedirs(self.directory, exist_ok=True)
+        stored = {'version': STORE_VERSION, 'prophet': self.prophet_version, 'cached': cached}
+        atomic_write(self._path(key), lambda f: pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL))
+        self._prune()
+
+    def _remove(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _prune(self):
+        """ Remove the least recently used models while the store is bigger than max_bytes """
+        for key in prune_lru(self.directory, '.pkl', max_bytes=self.max_bytes):
+            logger.info(f"Removed stored model {key[:12]}")
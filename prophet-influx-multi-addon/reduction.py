@@ -0,0 +1,68 @@
+""" Reduction of the training data before the Prophet fit.
+The fit time grows with the number of rows, and a query without a start time trains
+on the whole history at full resolution. The rows are reduced in the main process,
+before they are sent to the fit pool, shared by all the endpoints:
+- The rows with NaN y are dropped, Prophet ignores them anyway (e.g. counter resets).
+  The last row is kept, the forecast starts after it even if it is NaN.
+- The rows older than max_days before the last row are dropped.
+- The rows older than full_resolution_days are averaged in buckets of coarse_interval.
+- If there are still more than max_rows rows, the oldest full resolution rows are also
+  averaged in coarse buckets and, if that is not enough, the oldest buckets are dropped.
+"""
+import numpy as np
+import pandas as pd
+
+
+def coarse_buckets(times: np.ndarray, values: np.ndarray, interval: float) -> tuple:
+    """ Average the values in time buckets of interval seconds aligned to the unix epoch,
+    ignoring NaN. times must be sorted. Return (bucket start times, mean values).
+    """
+    buckets = times.astype('datetime64[ns]').astype(np.int64) // int(interval * 1e9)
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    valid = ~np.isnan(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.add.reduceat(np.where(valid, values, 0), starts) / np.add.reduceat(valid, starts)
+    return (buckets[starts] * int(interval * 1e9)).astype('datetime64[ns]'), means
+
+
+def reduce_training_data(df: pd.DataFrame, max_rows: int = 0, max_days: float = 0, full_resolution_days: float = 0,
+                         coarse_interval: float = 86400) -> pd.DataFrame:
+    """ Return df (columns 'ds' and 'y') reduced as described in the module docstring.
+    max_rows, max_days, full_resolution_days: 0 disables the reduction step.
+    coarse_interval: seconds of the buckets of the downsampled rows.
+    """
+    if not df['ds'].is_monotonic_increasing:
+        df = df.sort_values('ds')
+    keep = df['y'].notna().to_numpy(copy=True)
+    keep[-1:] = True
+    df = df[keep]
+    times = df['ds'].values.astype('datetime64[ns]')
+    values = df['y'].values.astype(np.float64)
+    if len(times) == 0:
+        return df
+
+    if max_days > 0:
+        first = np.searchsorted(times, times[-1] - np.timedelta64(int(max_days * 86400), 's'))
+        times, values = times[first:], values[first:]
+
+    # Rows before split are downsampled
+    split = 0
+    if full_resolution_days > 0:
+        split = np.searchsorted(times, times[-1] - np.timedelta64(int(full_resolution_days * 86400), 's'))
+    if 0 < max_rows < len(times):
+        # Rows if the first k rows are downsampled: n - k + coarse buckets of the first k rows
+        buckets = times.astype(np.int64) // int(coarse_interval * 1e9)
+        coarse_rows = np.cumsum(np.r_[True, buckets[1:] != buckets[:-1]])
+        total = len(times) - np.arange(1, len(times) + 1) + coarse_rows
+        within = np.flatnonzero(total <= max_rows)
+        split = max(split, within[0] + 1 if len(within) else len(times))
+
+    # The last row is never downsampled, the forecast starts after it
+    split = min(split, len(times) - 1)
+    if split > 0:
+        coarse_times, coarse_values = coarse_buckets(times[:split], values[:split], coarse_interval)
+        times = np.concatenate([coarse_times, times[split:]])
+        values = np.concatenate([coarse_values, values[split:]])
+    if 0 < max_rows < len(times):
+        times, values = times[-max_rows:], values[-max_rows:]
+    return pd.DataFrame({'ds': times, 'y': values})
@@ -0,0 +1,67 @@
+""" Serialization of the forecasts returned by the endpoints.
+The forecast DataFrame is converted to its response without going through pandas
+to_dict() and the jsonable_encoder of FastAPI: the dates are formatted by numpy in one
+call and the values are converted with tolist(), then FastJSONResponse encodes the
+result with orjson (if installed, json otherwise).
+Response formats:
+- dict: {"<date>": yhat, ...}, or {"yhat": {...}, "yhat_lower": {...}, "yhat_upper": {...}} with interval.
+- columns: {"ds": ["<date>", ...], "yhat": [...]} (and "yhat_lower", "yhat_upper" with interval).
+- epoch: like columns with "ds" in seconds since the unix epoch (UTC).
+"""
+import json
+import numpy as np
+import pandas as pd
+from fastapi.responses import JSONResponse
+from metrics import span
+
+try:
+    import orjson
+except ImportError:  # Not in the base image 1.0, the json module is used instead
+    orjson = None
+
+FORMATS = ('dict', 'columns', 'epoch')
+
+
+def iso_strings(times, utc: bool = False) -> list:
+    """ Format datetime64 values (UTC without timezone) as ISO 8601 strings.
+    utc: add the '+00:00' offset, like the isoformat of a timestamp with timezone.
+    Without utc the dates have no fractional seconds, like strftime('%Y-%m-%dT%H:%M:%S').
+    """
+    times = np.asarray(times, dtype='datetime64[ns]')
+    unit = 's'
+    if utc and (times.astype(np.int64) % 10**9).any():
+        unit = 'us'
+    strings = np.datetime_as_string(times, unit=unit)
+    if utc:
+        strings = np.char.add(strings, '+00:00')
+    return strings.tolist()
+
+
+def forecast_body(forecast: pd.DataFrame, interval: bool = False, format: str = 'dict', utc: bool = False):
+    """ Response of the endpoints for a forecast with the columns 'ds', 'yhat' and, with
+    interval, 'yhat_lower' and 'yhat_upper'. See the formats in the module docstring.
+    utc: the dates of the dict and columns formats have the '+00:00' offset.
+    """
+    with span("serialize"):
+        columns = ['yhat', 'yhat_lower', 'yhat_upper'] if interval else ['yhat']
+        times = forecast['ds'].values
+        if format == 'epoch':
+            ds = (np.asarray(times, dtype='datetime64[ns]').astype(np.int64) // 10**9).tolist()
+        else:
+            ds = iso_strings(times, utc)
+        values = {column: forecast[column].to_numpy(dtype=np.float64).tolist() for column in columns}
+        if format in ('columns', 'epoch'):
+            return {'ds': ds, **values}
+        if interval:
+            return {column: dict(zip(ds, values[column])) for column in columns}
+        return dict(zip(ds, values['yhat']))
+
+
+class FastJSONResponse(JSONResponse):
+    """ JSONResponse encoded with orjson when it is installed, timed as the serialize stage """
+
+    def render(self, content) -> bytes:
+        with span("serialize"):
+            if orjson is not None:
+                return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+            return json.dumps(content, ensure_ascii=False, separators=(',', ':'), default=str).encode()
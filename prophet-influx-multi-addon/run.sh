@@ -1,5 +1,14 @@
 #!/bin/bash
 
+# Number of uvicorn workers, option WORKERS of /data/options.json
+WORKERS=$(python -c "import json; print(int(json.load(open('${DATA_DIR:-/data}/options.json')).get('WORKERS', 1)))" 2>/dev/null || echo 1)
+
+if [ "$WORKERS" -gt 1 ]; then
+    echo "Starting addon Prophet InfluxDB with $WORKERS workers..."
+    # Every worker imports main:app, they share the caches under /data
+    exec python -m uvicorn main:app --app-dir /app --host 0.0.0.0 --port 5000 --workers "$WORKERS"
+fi
+
 echo "Starting addon Prophet InfluxDB..."
 
 # Execute main application
@@ -0,0 +1,211 @@
+""" In-process scheduler of the forecasting jobs configured in options.json.
+The jobs run in the background on an interval or a cron expression and keep their
+latest result in memory, so the automations that need a forecast at a known time
+get it without waiting for a fit.
+With several uvicorn workers only one of them runs the jobs. It also writes the state of
+every job to a directory, where the other workers read it.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from files import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# (minimum, maximum) of the fields of a cron expression: minute hour day month weekday
+CRON_FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+
+def parse_cron_field(field: str, minimum: int, maximum: int) -> set:
+    """ Values of a cron field like '*', '5', '1-5', '*/15', '0-30/10' or a list of them '0,30' """
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+        if part == '*':
+            start, end = minimum, maximum
+        elif '-' in part:
+            start, end = (int(v) for v in part.split('-', 1))
+        else:
+            start = int(part)
+            end = maximum if step > 1 else start
+        if start < minimum or end > maximum or start > end or step < 1:
+            raise ValueError(f"Invalid cron field: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    """ Standard 5 fields cron expression (minute hour day month weekday) in local time.
+    Sunday is 0 (7 is also accepted). Like cron, when both the day of the month and the
+    day of the week are restricted the job runs when any of them matches.
+    """
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Invalid cron expression: {expression}")
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            parse_cron_field(field, *limits) for field, limits in zip(fields, CRON_FIELDS))
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays  # Python weekday 0 is Monday
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next(self, after: datetime) -> datetime:
+        """ First time after after (exclusive) that matches the expression """
+        moment = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError("The cron expression never matches")
+
+
+class ForecastJob:
+    """ A forecast computed in the background.
+    interval: seconds between runs, aligned to multiples of the interval since the epoch
+    (like the GROUP BY time buckets) so an hourly job runs just after the hour.
+    cron: cron expression, used instead of interval.
+    offset: seconds added to every scheduled run, used to stagger the jobs.
+    request: the request of the endpoint that computes the forecast.
+    """
+
+    def __init__(self, name: str, endpoint: str, request, interval: float = None, cron: str = None, offset: float = 0):
+        if interval is None and cron is None:
+            raise ValueError(f"Job {name} needs an interval or a cron expression")
+        self.name = name
+        self.endpoint = endpoint
+        self.request = request
+        self.interval = interval
+        self.cron = CronSchedule(cron) if cron else None
+        self.offset = offset
+        self.result = None
+        self.updated = None  # Epoch seconds of the last successful run
+        self.duration = None  # Seconds of the last successful run
+        self.error = None  # Error of the last run, None if it succeeded
+        self.next_run = None
+
+    def schedule(self, now: float) -> float:
+        """ Epoch seconds of the next run after now """
+        if self.cron is not None:
+            next_run = self.cron.next(datetime.fromtimestamp(now - self.offset)).timestamp()
+        else:
+            next_run = (now - self.offset) // self.interval * self.interval + self.interval
+        self.next_run = next_run + self.offset
+        return self.next_run
+
+    # State of a job shared with the other workers
+    STATE = ('result', 'updated', 'duration', 'error', 'next_run')
+
+    def status(self, now: float = None) -> dict:
+        if now is None:
+            now = time.time()
+        return {
+            "job": self.name,
+            "endpoint": self.endpoint,
+            "updated": datetime.fromtimestamp(self.updated).astimezone().isoformat() if self.updated else None,
+            "age": round(now - self.updated, 3) if self.updated else None,
+            "duration": round(self.duration, 3) if self.duration is not None else None,
+            "next_run": datetime.fromtimestamp(self.next_run).astimezone().isoformat() if self.next_run else None,
+            "error": self.error,
+        }
+
+
+class Scheduler:
+    """ Run the jobs in the background with run_job(job) -> result.
+    Only one job runs at a time, a small CPU is not asked to fit all the models at once.
+    Every job is also run once at startup, staggered by its offset.
+    directory: if set, the state of the jobs is written there after every run, and the
+    schedulers that are not started load it with refresh().
+    """
+
+    def __init__(self, jobs: list, run_job, directory: str = None):
+        self.jobs = {job.name: job for job in jobs}
+        self.run_job = run_job
+        self.directory = directory
+        self._lock = asyncio.Lock()
+        self._tasks = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def _path(self, job: ForecastJob) -> str:
+        return os.path.join(self.directory, f"{job.name}.json")
+
+    def save(self, job: ForecastJob):
+        """ Write the state of job to the directory """
+        os.makedirs(self.directory, exist_ok=True)
+        state = {name: getattr(job, name) for name in ForecastJob.STATE}
+        atomic_write(self._path(job), lambda f: json.dump(state, f), mode='w')
+
+    def refresh(self):
+        """ Load the state of the jobs run by the scheduler of another worker """
+        if self.running or self.directory is None:
+            return
+        for job in self.jobs.values():
+            try:
+                with open(self._path(job)) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name in ForecastJob.STATE:
+                setattr(job, name, state.get(name))
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._loop(job)) for job in self.jobs.values()]
+        if self._tasks:
+            logger.info(f"Scheduled {len(self._tasks)} forecast jobs")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _loop(self, job: ForecastJob):
+        job.next_run = time.time() + job.offset
+        while True:
+            await asyncio.sleep(max(0, job.next_run - time.time()))
+            async with self._lock:
+                await self._run(job)
+            job.schedule(time.time())
+            if self.directory is not None:
+                try:
+                    self.save(job)
+                except (OSError, TypeError) as e:
+                    logger.error(f"Error saving the state of forecast job {job.name}: {e}")
+
+    async def _run(self, job: ForecastJob):
+        start = time.monotonic()
+        try:
+            job.result = await self.run_job(job)
+            job.updated = time.time()
+            job.duration = time.monotonic() - start
+            job.error = None
+            logger.info(f"Forecast job {job.name} done in {job.duration:.2f} s")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.error = str(getattr(e, 'detail', e))
+            logger.error(f"Forecast job {job.name} failed: {job.error}")
@@ -0,0 +1,229 @@
+""" Bounded pool of worker processes for the Prophet fits.
+The Stan fit of Prophet is CPU bound and takes seconds, so it must not run inside
+the event loop of uvicorn. The endpoints only dispatch the jobs to this pool and
+await them, while the other requests keep being served.
+Admission control: at most one job per worker process is given to the executor, the
+other jobs wait in the pool by priority class. The interactive jobs (the requests of
+the dashboards) are started before the bulk ones (batches, scheduled forecasts and the
+requests sent with X-Priority: bulk). When the queue is full a new job is rejected with
+503 and Retry-After, unless it is interactive and a bulk job is waiting: the newest bulk
+job is shed instead.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import math
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import HTTPException
+from metrics import FIT_POOL_BUSY_SECONDS, FIT_POOL_REJECTED, Timings, current_timings, record
+
+try:
+    import threadpoolctl
+except ImportError:  # Optional, the environment variables limit the threads started after the fork
+    threadpoolctl = None
+
+logger = logging.getLogger(__name__)
+
+# Priority classes of the jobs, the lower rank is started first
+PRIORITIES = {'interactive': 0, 'bulk': 1}
+# Priority of the jobs of the current request, set by the middleware, the batches and the scheduler
+fit_priority = contextvars.ContextVar('fit_priority', default='interactive')
+# Variables of the thread pools of the numeric libraries (BLAS, OpenMP) and of Stan
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'STAN_NUM_THREADS')
+
+
+def init_worker(threads: int = 0):
+    """ Initializer of the worker processes. They are forked from uvicorn and inherit its
+    signal handlers, restore the default ones so the workers end with the addon.
+    threads: limit of the threads of a fit (BLAS, OpenMP and the Stan process), 0 = no limit.
+    With one fit per core, more threads per fit only compete for the same cores.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C is handled by the main process
+    if threads > 0:
+        for variable in THREAD_VARIABLES:
+            os.environ[variable] = str(threads)
+        if threadpoolctl is not None:
+            # The thread pools of numpy were created before the fork
+            threadpoolctl.threadpool_limits(threads)
+
+
+def run_timed(fn, *args) -> tuple:
+    """ Run fn(*args) in a worker process with its own Timings.
+    Return (result, start time, duration, spans of fn) so the main process can add the
+    waiting time and the stages of the job (fit, predict) to the timings of the request.
+    """
+    timings = Timings()
+    current_timings.set(timings)
+    start = time.time()
+    result = fn(*args)
+    return result, start, time.time() - start, timings.spans
+
+
+class FitPool:
+    """ Process pool with admission control and a timeout per job.
+    max_workers: number of worker processes and of jobs run at the same time, 0 means one per CPU core.
+    timeout: seconds a request waits for its job (queued and running) before answering 504.
+    max_queue: jobs allowed to wait for a free worker before answering 503.
+    threads: threads per fit, see init_worker.
+    """
+
+    def __init__(self, max_workers: int = 0, timeout: float = 300, max_queue: int = 10, threads: int = 0):
+        self.max_workers = max_workers if max_workers > 0 else (os.cpu_count() or 1)
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.threads = threads
+        self.active = 0  # Jobs given to the executor and not finished yet
+        self.job_seconds = None  # Moving average of the duration of the jobs, for Retry-After
+        self._waiting = []  # Heap of [rank, sequence, priority, future] of the queued jobs
+        self._sequence = itertools.count()
+        self._executor = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        # The processes are created lazily with the first job
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_worker,
+                                                 initargs=(self.threads,))
+            logger.info(f"Fit pool started with {self.max_workers} worker processes")
+        return self._executor
+
+    @property
+    def running(self) -> int:
+        """ Number of jobs running in a worker """
+        return self.active
+
+    @property
+    def queued(self) -> int:
+        """ Number of jobs waiting for a free worker """
+        return len(self._waiting)
+
+    def state(self) -> dict:
+        """ Current state of the pool and of its queue, for /fit_pool """
+        queued = {priority: 0 for priority in PRIORITIES}
+        for _, _, priority, _ in self._waiting:
+            queued[priority] += 1
+        return {"workers": self.max_workers, "running": self.running, "queued": queued,
+                "max_queue": self.max_queue, "threads_per_fit": self.threads or None,
+                "job_seconds": round(self.job_seconds, 3) if self.job_seconds is not None else None,
+                "retry_after": self.retry_after()}
+
+    def retry_after(self) -> int:
+        """ Seconds until a worker is probably free for one more job """
+        job_seconds = self.job_seconds if self.job_seconds is not None else 5
+        return max(1, math.ceil(job_seconds * (self.queued + 1) / self.max_workers))
+
+    def _reject(self, priority: str, reason: str, detail: str) -> HTTPException:
+        FIT_POOL_REJECTED.inc(priority=priority, reason=reason)
+        return HTTPException(status_code=503, detail=detail, headers={"Retry-After": str(self.retry_after())})
+
+    def _admit_next(self):
+        """ Start the queued jobs with the highest priority while there are free workers """
+        while self._waiting and self.active < self.max_workers:
+            _, _, _, waiter = heapq.heappop(self._waiting)
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    def _release(self):
+        self.active -= 1
+        self._admit_next()
+
+    async def _admit(self, priority: str):
+        """ Wait until the job can be given to the executor """
+        if self.active < self.max_workers and not self._waiting:
+            self.active += 1
+            return
+        if len(self._waiting) >= self.max_queue:
+            newest = max(self._waiting, default=None)
+            if priority != 'interactive' or newest is None or newest[2] == 'interactive':
+                logger.warning(f"Fit pool queue is full ({self.queued} jobs waiting)")
+                raise self._reject(priority, "full", "Too many forecasts in progress, try again later")
+            # Make room for the interactive job, the newest bulk job is shed
+            self._waiting.remove(newest)
+            heapq.heapify(self._waiting)
+            logger.warning("Fit pool queue is full, a bulk job is shed for an interactive one")
+            newest[3].set_exception(self._reject(newest[2], "shed", "Forecast shed for interactive requests, try again later"))
+        waiter = asyncio.get_running_loop().create_future()
+        entry = [PRIORITIES[priority], next(self._sequence), priority, waiter]
+        heapq.heappush(self._waiting, entry)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                # Admitted and cancelled at the same time, the slot is not used
+                self._release()
+            elif entry in self._waiting:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+            raise
+
+    async def _run(self, fn, args: tuple, priority: str):
+        await self._admit(priority)
+        loop = asyncio.get_running_loop()
+
+        def job_done(future):
+            # The slot is freed when the job really ends, even after a timeout
+            try:
+                loop.call_soon_threadsafe(self._release)
+            except RuntimeError:  # The event loop is closed, the addon is stopping
+                pass
+
+        try:
+            future = self.executor.submit(run_timed, fn, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed by the OOM killer), start a new pool
+            logger.error("Fit pool is broken, restarting it")
+            self._executor = None
+            try:
+                future = self.executor.submit(run_timed, fn, *args)
+            except BaseException:
+                self._release()
+                raise
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(job_done)
+        return await asyncio.wrap_future(future)
+
+    async def run(self, fn, *args):
+        """ Run fn(*args) in a worker process and return its result.
+        The priority class of the job is the fit_priority of the context.
+        The time waiting for a free worker is recorded as the queue stage.
+        """
+        priority = fit_priority.get()
+        submitted = time.time()
+        try:
+            result, start, duration, spans = await asyncio.wait_for(self._run(fn, args, priority),
+                                                                    timeout=self.timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Forecast job did not finish in {self.timeout} seconds")
+            raise HTTPException(status_code=504, detail=f"Forecast did not finish in {self.timeout} seconds")
+        except BrokenProcessPool:
+            logger.error("A worker process of the fit pool died")
+            self._executor = None
+            raise HTTPException(status_code=500, detail="Forecast worker process died")
+        record("queue", max(start - submitted, 0.0))
+        for name, seconds in spans.items():
+            record(name, seconds)
+        FIT_POOL_BUSY_SECONDS.inc(duration)
+        self.job_seconds = duration if self.job_seconds is None else 0.8 * self.job_seconds + 0.2 * duration
+        return result
+
+    def shutdown(self):
+        for _, _, _, waiter in self._waiting:
+            waiter.cancel()
+        self._waiting = []
+        if self._executor is not None:
+            processes = list((self._executor._processes or {}).values())
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            # Don't wait for the fits in progress, and don't leave orphan workers behind
+            for process in processes:
+                process.terminate()
+            self._executor = None
@@ -0,0 +1,92 @@
+"""
+Regression test of the numpy energy path of the /energy_queries endpoint.
+It checks that influx.series_arrays + energy.delta_energy + energy.sum_delta_energy
+give the same series as the former pandas implementation (delta_energy_dataframe
+and pd.merge(..., how='outer')), which is kept below as reference.
+
+Run it with pytest from the root of the repository:
+    python -m pytest test/test_energy.py
+"""
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'prophet-influx-multi-addon'))
+from energy import delta_energy, sum_delta_energy  # noqa: E402
+from influx import series_arrays  # noqa: E402
+
+
+def reference_delta_energy_dataframe(points) -> pd.DataFrame:
+    """ delta_energy_dataframe as it was in main.py """
+    df = pd.DataFrame(points)
+    df['time'] = pd.to_datetime(df['time']).dt.tz_localize(None)
+    df.set_index('time', inplace=True)
+    df['delta_energy'] = df.iloc[:, 0].diff()
+    df = df.drop(df.index[0])
+    df = df.drop(df.index[-1])
+    mask = df['delta_energy'] < 0
+    df.loc[mask, 'delta_energy'] = np.nan
+    return df
+
+
+def reference_sum(df1, df2) -> pd.DataFrame:
+    """ Merge of the two queries as it was in main.py """
+    df = pd.merge(df1, df2, left_index=True, right_index=True, how='outer')
+    df['delta_energy'] = df['delta_energy_x'] + df['delta_energy_y']
+    df.reset_index(inplace=True)
+    return df[['time', 'delta_energy']]
+
+
+def influx_raw(start: datetime, hours: int, seed: int, epoch_ms: bool = False) -> dict:
+    """ Result of a cumulative energy query grouped by time(1h), with counter resets and nulls """
+    rng = np.random.default_rng(seed)
+    counter = np.cumsum(rng.uniform(0, 3, hours))
+    counter[hours // 3:] -= counter[hours // 3]  # Counter reset
+    values = [round(float(v), 3) for v in counter]
+    values[min(5, hours - 1)] = None  # fill(null) bucket
+    times = [start + timedelta(hours=i) for i in range(hours)]
+    if epoch_ms:
+        times = [int(t.timestamp() * 1000) for t in times]
+    else:
+        times = [t.strftime('%Y-%m-%dT%H:%M:%SZ') for t in times]
+    return {'statement_id': 0,
+            'series': [{'name': 'kWh', 'columns': ['time', 'energy_kWh'],
+                        'values': [list(row) for row in zip(times, values)]}]}
+
+
+def points(raw: dict) -> list:
+    series = raw['series'][0]
+    return [dict(zip(series['columns'], row)) for row in series['values']]
+
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize('epoch_ms', [False, True])
+def test_delta_energy_single_query(epoch_ms):
+    raw = influx_raw(START, 500, seed=1, epoch_ms=epoch_ms)
+    times, delta = delta_energy(*series_arrays(raw, epoch='ms' if epoch_ms else None))
+
+    expected = reference_delta_energy_dataframe(points(influx_raw(START, 500, seed=1)))
+    np.testing.assert_array_equal(times, expected.index.values.astype('datetime64[ns]'))
+    np.testing.assert_array_equal(delta, expected['delta_energy'].values)
+
+
+@pytest.mark.parametrize('offset_hours', [0, 7])
+def test_sum_delta_energy_two_queries(offset_hours):
+    raw1 = influx_raw(START, 400, seed=2)
+    raw2 = influx_raw(START + timedelta(hours=offset_hours), 450, seed=3)
+    times, delta = sum_delta_energy([delta_energy(*series_arrays(raw1)), delta_energy(*series_arrays(raw2))])
+
+    expected = reference_sum(reference_delta_energy_dataframe(points(raw1)),
+                             reference_delta_energy_dataframe(points(raw2)))
+    np.testing.assert_array_equal(times, expected['time'].values.astype('datetime64[ns]'))
+    np.testing.assert_array_equal(delta, expected['delta_energy'].values)
+
+
+def test_delta_energy_needs_two_points():
+    with pytest.raises(ValueError):
+        delta_energy(*series_arrays(influx_raw(START, 1, seed=4)))
@@ -0,0 +1,50 @@
+"""
+Tests of the atomic writes and of the pruning of the stores under /data (files.py).
+
+Run it with pytest from the root of the repository:
+    python -m pytest test/test_files.py
+"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'prophet-influx-multi-addon'))
+from files import atomic_write, prune_lru  # noqa: E402
+
+
+def write_file(directory, name: str, size: int, mtime: float):
+    path = os.path.join(directory, name)
+    atomic_write(path, lambda f: f.write(b'x' * size))
+    os.utime(path, (mtime, mtime))
+
+
+def test_atomic_write_failure_keeps_the_file(tmp_path):
+    path = str(tmp_path / 'a.json')
+    atomic_write(path, lambda f: f.write('{}'), mode='w')
+
+    def fail(f):
+        f.write('{"half": ')
+        raise RuntimeError('crash')
+
+    with pytest.raises(RuntimeError):
+        atomic_write(path, fail, mode='w')
+    assert open(path).read() == '{}'
+    assert os.listdir(tmp_path) == ['a.json']  # The temporary file is removed
+
+
+def test_prune_lru_max_bytes(tmp_path):
+    for n, name in enumerate(['old', 'new', 'middle']):
+        write_file(tmp_path, f'{name}.pkl', 100, [1000, 3000, 2000][n])
+    write_file(tmp_path, 'other.json', 1000, 0)  # Not a file of this store
+    assert prune_lru(str(tmp_path), '.pkl', max_bytes=250) == ['old']
+    assert prune_lru(str(tmp_path), '.pkl', max_bytes=100) == ['middle']
+    assert sorted(os.listdir(tmp_path)) == ['new.pkl', 'other.json']
+
+
+def test_prune_lru_max_entries_and_callbacks(tmp_path):
+    for n in range(4):
+        write_file(tmp_path, f'{n}.json', 10, 1000 + n)
+    removed = []
+    assert prune_lru(str(tmp_path), '.json', max_entries=2, size=lambda key: 1, remove=removed.append) == ['0', '1']
+    assert removed == ['0', '1']
+    assert prune_lru(str(tmp_path / 'missing'), '.json', max_entries=0) == []
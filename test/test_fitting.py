@@ -0,0 +1,53 @@
+"""
+Regression test of the fast prediction path (fitting.predict_fast), which rebuilds the
+predict of Prophet from its internals. It checks that fast=True gives the same dates and
+yhat as Prophet.predict for an additive and a multiplicative model, so a Prophet upgrade
+that changes those internals is caught here.
+
+Run it with pytest from the root of the repository:
+    python -m pytest test/test_fitting.py
+"""
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'prophet-influx-multi-addon'))
+from fitting import fit_model, predict, predict_dates  # noqa: E402
+
+pytest.importorskip('prophet')
+
+
+@pytest.fixture(scope='module', params=['additive', 'multiplicative'])
+def model(request):
+    # Two weeks of hourly data with a trend, a daily cycle and noise
+    ds = pd.date_range('2024-06-01', periods=14 * 24, freq='h')
+    hours = np.arange(len(ds))
+    rng = np.random.default_rng(1)
+    y = 10 + 0.01 * hours + 3 * np.sin(2 * np.pi * hours / 24) + rng.normal(0, 0.3, len(ds))
+    return fit_model(pd.DataFrame({'ds': ds, 'y': y}), profile={'seasonality_mode': request.param})
+
+
+def test_fast_predict_matches_prophet(model):
+    fast = predict(model, 48, 'h', fast=True)
+    full = predict(model, 48, 'h', fast=False)
+    assert list(fast.columns) == ['ds', 'yhat']
+    np.testing.assert_array_equal(fast['ds'].to_numpy(), full['ds'].to_numpy())
+    np.testing.assert_allclose(fast['yhat'].to_numpy(), full['yhat'].to_numpy(), rtol=1e-9, atol=1e-9)
+
+
+def test_fast_predict_dates_matches_prophet(model):
+    dates = pd.Series(pd.to_datetime(['2024-06-10 05:00', '2024-06-15 12:00', '2024-06-20 23:00']))
+    fast = predict_dates(model, dates, fast=True)
+    full = predict_dates(model, dates, fast=False)
+    np.testing.assert_array_equal(fast['ds'].to_numpy(), full['ds'].to_numpy())
+    np.testing.assert_allclose(fast['yhat'].to_numpy(), full['yhat'].to_numpy(), rtol=1e-9, atol=1e-9)
+
+
+def test_fast_predict_interval(model):
+    fast = predict(model, 24, 'h', fast=True, interval=True)
+    assert list(fast.columns) == ['ds', 'yhat', 'yhat_lower', 'yhat_upper']
+    assert len(fast) == 24
+    assert not fast[['yhat_lower', 'yhat_upper']].isna().any().any()
+    assert (fast['yhat_lower'] < fast['yhat_upper']).all()
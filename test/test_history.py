@@ -0,0 +1,123 @@
+"""
+Tests of the incremental reads of the history store (history.HistoryStore) and of the
+InfluxQL time bounds they rely on (influxql.split_time_bounds).
+The InfluxDB server is replaced by a small function that aggregates raw points in hourly
+buckets with last() and applies the time bounds and fill() of the query, like InfluxDB.
+
+Run it with pytest from the root of the repository:
+    python -m pytest test/test_history.py
+"""
+import os
+import sys
+from datetime import datetime, timezone
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'prophet-influx-multi-addon'))
+from history import HistoryStore, fill_previous  # noqa: E402
+from influxql import fill_option, split_time_bounds  # noqa: E402
+
+ORIGIN = datetime(2024, 6, 1, tzinfo=timezone.utc).timestamp()
+HOUR = 3600
+QUERY = """SELECT last("value") AS "energy_kWh" FROM "kWh" WHERE "entity_id"='solar' GROUP BY time(1h) fill({})"""
+
+
+class FakeServer:
+    """ Raw points (hour, value) of a counter and the current hour, queried like InfluxDB """
+
+    def __init__(self, points: dict, now: int):
+        self.points = points
+        self.now = now
+        self.queries = []
+
+    def run_query(self, str_query: str) -> tuple:
+        self.queries.append(str_query)
+        bounds = split_time_bounds(str_query, now=ORIGIN + self.now * HOUR)
+        first = min(self.points) if bounds.start is None else int((bounds.start - ORIGIN) // HOUR)
+        hours = range(first, self.now + 1)
+        values = []
+        for hour in hours:
+            value = self.points.get(hour, np.nan)
+            if np.isnan(value) and fill_option(str_query) == 'previous' and values:
+                value = values[-1]  # Only the points inside the range of the query are carried forward
+            values.append(value)
+        times = np.array([np.datetime64(int(ORIGIN + hour * HOUR), 's') for hour in hours], dtype='datetime64[ns]')
+        return times, np.array(values, dtype=np.float64)
+
+
+def test_split_time_bounds():
+    query = ("SELECT last(\"value\") FROM \"kWh\" WHERE (time >= '2024-06-01T00:00:00Z') AND \"entity_id\"='a' "
+             "AND time < now() - 1d GROUP BY time(1h) fill(previous)")
+    bounds = split_time_bounds(query, now=ORIGIN + 10 * 86400)
+    assert bounds.start == ORIGIN and bounds.start_inclusive
+    assert bounds.end == ORIGIN + 9 * 86400 and not bounds.end_inclusive
+    assert bounds.base_query == "SELECT last(\"value\") FROM \"kWh\" WHERE \"entity_id\"='a' GROUP BY time(1h) fill(previous)"
+    assert bounds.query_from('2024-06-05T00:00:00Z') == (
+        "SELECT last(\"value\") FROM \"kWh\" WHERE time >= '2024-06-05T00:00:00Z' AND time < now() - 1d "
+        "AND \"entity_id\"='a' GROUP BY time(1h) fill(previous)")
+
+
+def test_split_time_bounds_without_where():
+    bounds = split_time_bounds('SELECT mean("value") FROM "W" GROUP BY time(1h)')
+    assert bounds.start is None and bounds.end is None
+    assert bounds.query_from('2024-06-05T00:00:00Z') == \
+        "SELECT mean(\"value\") FROM \"W\" WHERE time >= '2024-06-05T00:00:00Z' GROUP BY time(1h)"
+
+
+@pytest.mark.parametrize('query', [
+    "SELECT * FROM m WHERE time > now() - 1d OR \"entity_id\"='a'",  # OR with a time condition
+    "SELECT * FROM m WHERE time > now() - 1d AND time > now() - 2d",  # Two start bounds
+    "SELECT * FROM m WHERE time > 1717200000000000000",  # Epoch literal, not understood
+])
+def test_split_time_bounds_unsupported(query):
+    assert split_time_bounds(query) is None
+
+
+def test_split_time_bounds_escaped_quote():
+    bounds = split_time_bounds("SELECT * FROM m WHERE \"entity_id\" = 'a\\' OR (b' AND time >= now() - 1d", now=ORIGIN)
+    assert bounds is not None
+    assert bounds.start == ORIGIN - 86400
+    assert bounds.conditions == ["\"entity_id\" = 'a\\' OR (b'"]
+
+
+def test_fill_previous():
+    nan = np.nan
+    filled = fill_previous(np.array([nan, nan, 7.0, nan]), np.array([1.0, 5.0]))
+    np.testing.assert_array_equal(filled, [5.0, 5.0, 7.0, nan])
+    np.testing.assert_array_equal(fill_previous(np.array([nan]), np.array([])), [nan])
+    np.testing.assert_array_equal(fill_previous(np.array([2.0, nan]), np.array([1.0])), [2.0, nan])
+
+
+@pytest.mark.parametrize('fill', ['previous', 'null'])
+def test_incremental_read_matches_full_read(tmp_path, fill):
+    # A solar counter that doesn't change at night: no points from hour 4 to hour 9
+    server = FakeServer({0: 1.0, 1: 2.0, 2: 4.0, 3: 5.0}, now=6)
+    store = HistoryStore(str(tmp_path))
+    query = QUERY.format(fill)
+    times, values = store.query(('influx', 8086, 'ha'), query, server.run_query)
+    np.testing.assert_array_equal(values, server.run_query(query)[1])
+
+    # The counter moves again, only the buckets from the last stored one are requested
+    server.points[10] = 9.0
+    server.now = 11
+    times, values = store.query(('influx', 8086, 'ha'), query, server.run_query)
+    assert "time >= '2024-06-01T06:00:00Z'" in server.queries[-1]
+    full_times, full_values = server.run_query(query)
+    np.testing.assert_array_equal(times, full_times)
+    np.testing.assert_array_equal(values, full_values)
+    if fill == 'previous':
+        np.testing.assert_array_equal(values[3:], [5.0, 5.0, 5.0, 5.0, 5.0, 5.0, 5.0, 9.0, 9.0])
+
+
+def test_incremental_read_replaces_last_bucket(tmp_path):
+    server = FakeServer({0: 1.0, 1: 2.0, 2: 3.0}, now=2)
+    store = HistoryStore(str(tmp_path))
+    query = QUERY.format('previous')
+    store.query(('influx', 8086, 'ha'), query, server.run_query)
+    # The last bucket was not complete yet, its value changed
+    server.points[2] = 3.5
+    server.points[3] = 4.0
+    server.now = 3
+    times, values = store.query(('influx', 8086, 'ha'), query, server.run_query)
+    assert len(times) == 4
+    np.testing.assert_array_equal(values, [1.0, 2.0, 3.5, 4.0])
@@ -0,0 +1,46 @@
+"""
+Tests of the downsampling of the query results while their chunks arrive (influx.SeriesBuffer).
+
+Run it with pytest from the root of the repository:
+    python -m pytest test/test_influx.py
+"""
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'prophet-influx-multi-addon'))
+from influx import SeriesBuffer  # noqa: E402
+
+
+def raw_points(n: int) -> tuple:
+    times = np.datetime64('2024-06-01T00:00', 'ns') + np.arange(n) * np.timedelta64(1, 'h')
+    return times, np.arange(n, dtype=np.float64)
+
+
+@pytest.mark.parametrize('chunk', [1, 3, 10])
+def test_every_point_averages_factor_raw_points(chunk):
+    # 7 points with max_points 6: the first halving leaves an odd point, and so does the second one
+    times, values = raw_points(45)
+    buffer = SeriesBuffer(max_points=6)
+    for start in range(0, len(times), chunk):
+        buffer.append(times[start:start + chunk], values[start:start + chunk])
+    assert buffer.factor == 8
+    stored_times, stored_values = buffer.arrays()
+    factor = buffer.factor
+    complete = len(times) // factor
+    np.testing.assert_array_equal(stored_times[:complete], times[:complete * factor:factor])
+    np.testing.assert_array_equal(stored_values[:complete], values[:complete * factor].reshape(-1, factor).mean(axis=1))
+    # The last incomplete group is one point
+    assert len(stored_times) == complete + 1
+    assert stored_values[-1] == values[complete * factor:].mean()
+
+
+def test_without_max_points_keeps_every_point():
+    times, values = raw_points(10)
+    buffer = SeriesBuffer(capacity=4)
+    buffer.append(times[:7], values[:7])
+    buffer.append(times[7:], values[7:])
+    stored_times, stored_values = buffer.arrays()
+    np.testing.assert_array_equal(stored_times, times)
+    np.testing.assert_array_equal(stored_values, values)